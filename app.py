@@ -1,12 +1,15 @@
-import os, sqlite3, threading, time, re
+import os, sqlite3, threading, time, re, bisect, heapq, queue, uuid, functools, socket, atexit, json, gzip, math, copy
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from flask import Flask, request, abort, g
+from flask import Flask, Response, request, abort
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from requests.exceptions import RequestException
 from linebot.models import (
-    MessageEvent, TextMessage, TextSendMessage,
-    QuickReply, QuickReplyButton, MessageAction, URIAction,
-    PostbackEvent, PostbackAction
+    MessageEvent, TextMessage, LocationMessage,
+    PostbackEvent
 )
 
 app = Flask(__name__)
@@ -18,9 +21,20 @@ if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
     # 讓 Render log 更好讀（仍會啟動，但 LineBotApi 會在呼叫時失敗）
     print("WARNING: LINE_CHANNEL_ACCESS_TOKEN / LINE_CHANNEL_SECRET not set")
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+# LINE_API_ENDPOINT：可指到本機假 LINE API（壓測 / 離線測試用）
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT")
+if LINE_API_ENDPOINT:
+    line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT)
+else:
+    line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
+
+def set_line_api(api):
+    # 換掉 LINE API client（本機 stub 只需實作 reply_message / push_message / multicast）
+    global line_bot_api
+    line_bot_api = api
+
 SYSTEM_GROUP_LINK = "https://line.me/R/ti/g/一般玩家群"
 
 ADMIN_IDS = {
@@ -28,141 +42,942 @@ ADMIN_IDS = {
 }
 
 DB_PATH = "data.db"
-user_state = {}
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))              # 每條連線的 page cache
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))  # prepared statement 快取數
+NICKNAME_CACHE_SIZE = int(os.getenv("NICKNAME_CACHE_SIZE", "10000"))  # 暱稱快取上限（LRU）
+NOTES_PAGE_SIZE = int(os.getenv("NOTES_PAGE_SIZE", "30"))  # 記事本月報表每頁筆數
+SHOP_PAGE_SIZE = min(9, int(os.getenv("SHOP_PAGE_SIZE", "9")))  # 店家選單每頁家數（quick reply 最多 13 顆，要留下一頁/搜尋/附近店家/回主選單）
+NEARBY_SHOPS = min(12, int(os.getenv("NEARBY_SHOPS", "5")))    # 傳位置時回幾家最近的營業店家（每家一顆地圖按鈕 + 回主選單，quick reply 最多 13 顆）
+NEARBY_MAX_KM = float(os.getenv("NEARBY_MAX_KM", "20"))        # 超過這個距離的店不列出
+SHOP_GRID_DEG = float(os.getenv("SHOP_GRID_DEG", "0.02"))      # 店家位置格子索引每格邊長（度；0.02° ≈ 2 km）
+LOCATION_INPUT_SEC = int(os.getenv("LOCATION_INPUT_SEC", "180"))  # 按「設定位置」後多久內傳的位置才當成店家位置
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))                # 流程狀態閒置多久作廢（秒）
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))  # 流程狀態記憶體快取上限（LRU）
+SESSION_SWEEP_SEC = int(os.getenv("SESSION_SWEEP_SEC", "300"))      # 多久清一次過期的 session_state
 
 COUNTDOWN_READY = 30  # ✅ 30 秒確認
 
+PUSH_WORKERS = int(os.getenv("PUSH_WORKERS", "4"))
+NOTIFY_COALESCE_MS = int(os.getenv("NOTIFY_COALESCE_MS", "300"))  # 同桌通知合併視窗（0 = 不合併）
+
+# CALLBACK_ASYNC=1：/callback 驗完簽章就回 200，事件丟到背景 worker（同一使用者依序、不同使用者並行）
+CALLBACK_ASYNC = os.getenv("CALLBACK_ASYNC", "0") == "1"
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "8"))
+# 同步模式：同一次 webhook 帶多個使用者的事件時，依使用者分組並行處理（1 = 照順序一個一個來）
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "8"))
+
+# MULTI_WORKER=1：多個 process 共用同一個 data.db（gunicorn 多 worker）。
+# 到期排程只由持有 lease 的那個 worker 執行；記憶體快取（配桌池 / 店家 / 暱稱）靠 cache_versions 互相失效。
+MULTI_WORKER = os.getenv("MULTI_WORKER", "0") == "1"
+LEASE_TTL = float(os.getenv("LEASE_TTL", "10"))                     # leader 掛掉後最多這麼久換人
+SCHEDULER_SYNC_SEC = float(os.getenv("SCHEDULER_SYNC_SEC", "1"))    # leader 多久檢查一次其他 worker 開的新桌
+PUSH_MAX_RETRY = int(os.getenv("PUSH_MAX_RETRY", "3"))
+MATCH_DELAY_MS = int(os.getenv("MATCH_DELAY_MS", "50"))        # 池有變動後多久整批重新配桌（同一段時間內的變動合併處理）
+MATCH_BATCH_POOLS = int(os.getenv("MATCH_BATCH_POOLS", "100"))  # 每一輪最多處理幾個池，剩下的接著下一輪
+MATCH_SKIP_LIMIT = int(os.getenv("MATCH_SKIP_LIMIT", "8"))  # 整池配桌時，同一組最多被後來的插隊幾次（為了多湊桌；0 = 完全照順序）
+# 資料保存 / 背景維護：只有 scheduler leader 做，而且等一段時間沒有事件進來才做
+MAINT_INTERVAL_SEC = int(os.getenv("MAINT_INTERVAL_SEC", "3600"))  # 多久做一次
+MAINT_QUIET_SEC = int(os.getenv("MAINT_QUIET_SEC", "120"))          # 多久沒有事件算安靜
+MAINT_BATCH = int(os.getenv("MAINT_BATCH", "2000"))                 # 封存每批筆數（每批一個交易）
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "1000"))     # incremental_vacuum 每次還給檔案系統的頁數
+NOTES_KEEP_MONTHS = max(2, int(os.getenv("NOTES_KEEP_MONTHS", "6")))  # 記事本留在 DB 的月數（含本月；查看上月至少要 2）
+HISTORY_KEEP_DAYS = int(os.getenv("HISTORY_KEEP_DAYS", "30"))       # 完成配桌紀錄留在 DB 的天數
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")                   # 封存檔目錄（每種每月一個 .jsonl.gz）
+MAINT_FULL_VACUUM = os.getenv("MAINT_FULL_VACUUM", "0") == "1"      # 舊檔轉 incremental 要整檔 VACUUM（會鎖住寫入），只在停機維護時開
+SQL_TRACE = os.getenv("SQL_TRACE", "0") == "1"          # 逐事件記錄 SQL（找 N+1 / 慢查詢用，平常關著）
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50"))      # 慢查詢門檻（毫秒）
+SQL_NPLUS1 = int(os.getenv("SQL_NPLUS1", "4"))           # 同一事件內同一句 SQL 重複幾次算 N+1 嫌疑
+
+
+# ===== 監控指標（/metrics，Prometheus 文字格式）=====
+# 全部是記憶體計數，抓取時不碰資料庫；gauge 在抓取當下由 callback 讀記憶體狀態。
+# 多 worker 時每個 process 各算各的（pid 也在 /stats）。
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.meta = {}        # name -> (type, help)，輸出順序照註冊順序
+        self.bounds = {}      # histogram name -> buckets
+        self.counters = {}    # name -> {labels: value}
+        self.histograms = {}  # name -> {labels: [每個 bucket 的次數..., sum, count]}
+        self.gauges = {}      # name -> fn() -> 數值 或 {labels: 數值}
+
+    def counter(self, name, help_text):
+        self.meta[name] = ("counter", help_text)
+        self.counters[name] = {}
+
+    def histogram(self, name, help_text, buckets=None):
+        self.meta[name] = ("histogram", help_text)
+        self.histograms[name] = {}
+        self.bounds[name] = buckets or self.buckets
+
+    def gauge(self, name, help_text, fn):
+        self.meta[name] = ("gauge", help_text)
+        self.gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        bounds = self.bounds[name]
+        i = bisect.bisect_left(bounds, seconds)
+        with self.lock:
+            series = self.histograms[name]
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [0] * (len(bounds) + 2)
+            if i < len(bounds):
+                h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def render(self):
+        with self.lock:
+            counters = {n: dict(s) for n, s in self.counters.items()}
+            histograms = {n: {k: list(h) for k, h in s.items()} for n, s in self.histograms.items()}
+        out = []
+        for name, (kind, help_text) in self.meta.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for key, v in counters[name].items():
+                    out.append(f"{name}{_labels(key)} {v}")
+            elif kind == "histogram":
+                for key, h in histograms[name].items():
+                    total = 0
+                    for le, n in zip(self.bounds[name], h):
+                        total += n
+                        out.append(f"{name}_bucket{_labels(key + (('le', le),))} {total}")
+                    out.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {h[-1]}")
+                    out.append(f"{name}_sum{_labels(key)} {h[-2]:.6f}")
+                    out.append(f"{name}_count{_labels(key)} {h[-1]}")
+            else:
+                try:
+                    value = self.gauges[name]()
+                except Exception as e:
+                    print("metrics gauge error:", name, e)
+                    continue
+                if isinstance(value, dict):
+                    for key, v in value.items():
+                        out.append(f"{name}{_labels(key)} {v}")
+                else:
+                    out.append(f"{name} {value}")
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics(LATENCY_BUCKETS)
+metrics.histogram("mahjong_command_seconds", "Webhook handler latency per command, including commit")
+metrics.counter("mahjong_command_errors_total", "Webhook handlers that raised")
+metrics.histogram("mahjong_line_api_seconds", "LINE Messaging API call latency")
+metrics.counter("mahjong_line_api_errors_total", "LINE Messaging API call failures")
+metrics.counter("mahjong_db_commits_total", "SQLite transactions committed")
+metrics.counter("mahjong_db_rollbacks_total", "SQLite transactions rolled back")
+metrics.histogram("mahjong_delivery_seconds", "Time to process one synchronous /callback delivery (all events)")
+metrics.counter("mahjong_delivery_events_total", "Events received in synchronous /callback deliveries")
+metrics.histogram("mahjong_scheduler_task_seconds", "Deadline scheduler task duration (reminders, expiry, notify flush)")
+metrics.histogram("mahjong_scheduler_lag_seconds", "Delay between a task's deadline and when it started")
+metrics.counter("mahjong_match_conflicts_total", "Table seatings retried because the in-memory pool was stale")
+metrics.counter("mahjong_match_cycles_total", "Matcher cycles that drained dirty pools")
+metrics.counter("mahjong_match_pools_evaluated_total", "Dirty pools re-evaluated by the matcher")
+metrics.histogram("mahjong_match_cycle_pools", "Pools re-evaluated per matcher cycle", (1, 2, 5, 10, 20, 50, 100, 200, 500))
+metrics.counter("mahjong_archived_rows_total", "Rows moved from data.db to archive files")
+metrics.counter("mahjong_vacuum_reclaimed_bytes_total", "Bytes returned to the filesystem by maintenance")
+metrics.counter("mahjong_sql_statements_total", "SQL statements per event tag (SQL_TRACE only)")
+metrics.counter("mahjong_sql_seconds_total", "SQL execute time per event tag (SQL_TRACE only)")
+metrics.counter("mahjong_sql_nplus1_total", "Events with a statement repeated SQL_NPLUS1+ times (SQL_TRACE only)")
+
+
+# ===== SQL 追蹤（SQL_TRACE=1）=====
+# 連線掛 trace callback：每一句實際執行的 SQL（含隱含的 BEGIN / COMMIT）都記到目前這個事件底下，
+# 事件標籤 = 事件類型:實際指令（例如 message:on_confirm、scheduler:table_expire）。
+# 執行時間由 TracedConnection 包住 execute / commit 量，算在最後一句被 trace 到的 SQL 上。
+# 事件結束時同一個 SQL 形狀（字面值換成 ?）出現 SQL_NPLUS1 次以上就記一筆 N+1 嫌疑。
+
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_SPACE = re.compile(r"\s+")
+
+
+def sql_shape(sql):
+    return _SQL_SPACE.sub(" ", _SQL_LITERAL.sub("?", sql)).strip()
+
+
+class SqlTracer:
+    def __init__(self, enabled, slow_ms, nplus1):
+        self.enabled = enabled
+        self.slow = slow_ms / 1000.0
+        self.nplus1 = nplus1
+        self.lock = threading.Lock()
+        self.stats = {}     # tag -> [事件數, SQL 句數, 秒數, N+1 事件數]
+        self.reported = set()  # 已印過的 (tag, shape)，同一個 N+1 只印一次
+
+    def begin(self, kind):
+        if self.enabled:
+            _db_local.trace = {"kind": kind, "statements": []}
+
+    def _tag(self, kind, command):
+        # postback 的指令名本身就是 "postback:<前綴>"，不要再接一次 kind
+        command = command or "-"
+        return command if command.startswith(kind + ":") else f"{kind}:{command}"
+
+    def tag(self):
+        t = getattr(_db_local, "trace", None)
+        if t is None:
+            return "background"
+        return self._tag(t["kind"], getattr(_db_local, "command", None))
+
+    def statement(self, sql):
+        # sqlite3 trace callback；executemany 每一列各觸發一次，標成 bulk（照算句數，但不算 N+1）
+        entry = [sql, 0.0, getattr(_db_local, "trace_bulk", False)]
+        _db_local.trace_last = entry
+        t = getattr(_db_local, "trace", None)
+        if t is not None:
+            t["statements"].append(entry)
+
+    def timed(self, seconds):
+        entry = getattr(_db_local, "trace_last", None)
+        if entry is None:
+            return
+        _db_local.trace_last = None
+        entry[1] += seconds
+        if seconds >= self.slow:
+            print(f"sql slow {seconds * 1000:.1f}ms [{self.tag()}] {sql_shape(entry[0])[:300]}")
+
+    def end(self, command=None):
+        t = getattr(_db_local, "trace", None)
+        if t is None:
+            return
+        tag = self._tag(t["kind"], command or getattr(_db_local, "command", None))
+        _db_local.trace = None
+        _db_local.trace_last = None
+        statements = t["statements"]
+        seconds = sum(e[1] for e in statements)
+        shapes = {}
+        for sql, _sec, bulk in statements:
+            if bulk:
+                continue
+            shape = sql_shape(sql)
+            shapes[shape] = shapes.get(shape, 0) + 1
+        repeated = [(n, shape) for shape, n in shapes.items() if n >= self.nplus1 and shape not in ("BEGIN", "COMMIT")]
+        with self.lock:
+            st = self.stats.get(tag)
+            if st is None:
+                st = self.stats[tag] = [0, 0, 0.0, 0]
+            st[0] += 1
+            st[1] += len(statements)
+            st[2] += seconds
+            st[3] += 1 if repeated else 0
+            fresh = [(n, shape) for n, shape in repeated if (tag, shape) not in self.reported]
+            self.reported.update((tag, shape) for _n, shape in fresh)
+        metrics.inc("mahjong_sql_statements_total", len(statements), command=tag)
+        metrics.inc("mahjong_sql_seconds_total", seconds, command=tag)
+        if repeated:
+            metrics.inc("mahjong_sql_nplus1_total", command=tag)
+        for n, shape in fresh:
+            print(f"sql n+1 [{tag}] {n}x {shape[:300]}")
+
+    def summary(self):
+        with self.lock:
+            items = sorted(self.stats.items(), key=lambda kv: -kv[1][1])
+        return {
+            tag: {
+                "events": ev,
+                "statements_per_event": round(n / ev, 2),
+                "ms_per_event": round(sec * 1000 / ev, 3),
+                "nplus1_events": bad,
+            }
+            for tag, (ev, n, sec, bad) in items
+        }
+
+
+sql_tracer = SqlTracer(SQL_TRACE, SQL_SLOW_MS, SQL_NPLUS1)
+
+
+class TracedConnection(sqlite3.Connection):
+    def execute(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            sql_tracer.timed(time.perf_counter() - t0)
+
+    def executemany(self, *args):
+        _db_local.trace_bulk = True
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            _db_local.trace_bulk = False
+            sql_tracer.timed(time.perf_counter() - t0)
+
+    def executescript(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().executescript(*args)
+        finally:
+            sql_tracer.timed(time.perf_counter() - t0)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            sql_tracer.timed(time.perf_counter() - t0)
+
+
+# ===== 資料庫連線 =====
+# 每個執行緒一條長駐連線（webhook / 事件 worker / 排程 / 推播共用同一套），不再每個 request 重開。
+_db_local = threading.local()
+
+
+def connect_db():
+    factory = TracedConnection if sql_tracer.enabled else sqlite3.Connection
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10, cached_statements=DB_STATEMENT_CACHE, factory=factory)
+    if sql_tracer.enabled:
+        db.set_trace_callback(sql_tracer.statement)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA auto_vacuum=INCREMENTAL")  # 只對新建的空檔有效；舊檔由背景維護轉換
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    db.execute("PRAGMA temp_store=MEMORY")
+    return db
+
 
 def get_db():
-    if "db" not in g:
-        db = sqlite3.connect(DB_PATH, check_same_thread=False)
-        db.row_factory = sqlite3.Row
-        g.db = db
-    return g.db
+    db = getattr(_db_local, "db", None)
+    if db is None:
+        db = _db_local.db = connect_db()
+    return db
 
 
 @app.teardown_appcontext
-def close_db(e=None):
-    db = g.pop("db", None)
-    if db:
-        db.close()
+def release_db(e=None):
+    # 連線留著重用；只把沒 commit 的殘留交易收掉，避免帶到下一個事件
+    db = getattr(_db_local, "db", None)
+    if db is not None and db.in_transaction:
+        db.rollback()
+
+
+# ===== 單一事件單一交易（unit of work）=====
+# 處理一個 webhook 事件 / 一個排程到期時，期間所有寫入合成一個 transaction，最後只 commit 一次。
+# 期間呼叫 commit(db) 不會真的 commit；出例外整批 rollback，並跑 on_rollback 登記的補償（例如重建記憶體配桌池）。
+# 回覆 / 推播用 after_commit 延到 commit 之後才送，不會在持有寫入鎖時打 LINE API，也不會送出被 rollback 的結果。
+
+@contextmanager
+def unit_of_work():
+    db = get_db()
+    if getattr(_db_local, "uow", None) is not None:
+        yield db
+        return
+    uow = _db_local.uow = {"after_commit": [], "on_rollback": []}
+    try:
+        yield db
+        db.commit()
+        metrics.inc("mahjong_db_commits_total")
+    except Exception:
+        db.rollback()
+        metrics.inc("mahjong_db_rollbacks_total")
+        _db_local.uow = None
+        for fn in uow["on_rollback"]:
+            try:
+                fn()
+            except Exception as e:
+                print("rollback hook error:", e)
+        raise
+    _db_local.uow = None
+    for fn in uow["after_commit"]:
+        try:
+            fn()
+        except Exception as e:
+            print("after_commit error:", e)
+
+
+def transactional(fn):
+    # 給 webhook handler 用（WebhookHandler 依參數個數決定怎麼呼叫，所以維持單一 event 參數）
+    # 順便計時；handler 內可用 set_command 把標籤換成實際走到的指令
+    @functools.wraps(fn)
+    def wrapper(event):
+        _db_local.command = fn.__name__
+        sql_tracer.begin(getattr(event, "type", "event"))
+        t0 = time.perf_counter()
+        try:
+            with unit_of_work():
+                maintenance.touch()
+                return fn(event)
+        except Exception:
+            metrics.inc("mahjong_command_errors_total", command=_db_local.command)
+            raise
+        finally:
+            metrics.observe("mahjong_command_seconds", time.perf_counter() - t0, command=_db_local.command)
+            sql_tracer.end()
+            _db_local.command = None
+    return wrapper
+
+
+def set_command(name):
+    _db_local.command = name
+
+
+def commit(db):
+    if getattr(_db_local, "uow", None) is None:
+        db.commit()
+        metrics.inc("mahjong_db_commits_total")
+
+
+def after_commit(fn):
+    uow = getattr(_db_local, "uow", None)
+    if uow is None:
+        fn()
+    else:
+        uow["after_commit"].append(fn)
+
+
+def on_rollback(fn):
+    uow = getattr(_db_local, "uow", None)
+    if uow is not None:
+        uow["on_rollback"].append(fn)
+
+
+def call_line_api(method, *args, api=None, **kwargs):
+    # 所有 LINE API 呼叫都經過這裡：計時 + 失敗計數（依 HTTP 狀態或例外類型），例外照樣往外丟
+    # api：指定用哪個 client（推播 worker 用自己的），預設共用的 line_bot_api
+    t0 = time.perf_counter()
+    try:
+        return getattr(api or line_bot_api, method)(*args, **kwargs)
+    except Exception as e:
+        status = getattr(e, "status_code", None) or type(e).__name__
+        metrics.inc("mahjong_line_api_errors_total", method=method, status=status)
+        raise
+    finally:
+        metrics.observe("mahjong_line_api_seconds", time.perf_counter() - t0, method=method)
+
+
+def reply(reply_token, message):
+    def send():
+        try:
+            call_line_api("reply_message", reply_token, message)
+        except Exception as e:
+            print("reply error:", e)
+    after_commit(send)
+
+
+# ===== 資料庫 schema（版本化 migration）=====
+# 版本記在 PRAGMA user_version；啟動時只跑一次，依序補上尚未套用的版本。
+# 每一步可以是 SQL 字串或 callable(db)；同一版本在同一個 transaction 裡完成。
+MIGRATIONS = [
+    # v1：原始資料表（舊的 data.db 已經有這些表，IF NOT EXISTS 直接略過）
+    [
+        """
+        CREATE TABLE IF NOT EXISTS match_users(
+            user_id TEXT PRIMARY KEY,
+            people INT,
+            shop_id TEXT,
+            amount TEXT,
+            status TEXT,
+            expire REAL,
+            table_id TEXT,
+            table_index INT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tables(
+            id TEXT PRIMARY KEY,
+            shop_id TEXT,
+            amount TEXT,
+            table_index INT,
+            created REAL,
+            r20 INT DEFAULT 0,
+            r10 INT DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS notes(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            content TEXT,
+            amount INT,
+            time TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS shops(
+            shop_id TEXT PRIMARY KEY,
+            name TEXT,
+            open INT,
+            approved INT,
+            group_link TEXT,
+            owner_id TEXT,
+            partner_map TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS nicknames(
+            user_id TEXT PRIMARY KEY,
+            nickname TEXT
+        )
+        """,
+        # 使用者流程暫存（避免多進程/重啟造成記憶體狀態遺失）
+        """
+        CREATE TABLE IF NOT EXISTS session_state(
+            user_id TEXT PRIMARY KEY,
+            shop_id TEXT,
+            amount TEXT,
+            updated REAL
+        )
+        """,
+    ],
+    # v2：熱路徑索引
+    [
+        "CREATE INDEX IF NOT EXISTS idx_match_users_pool ON match_users(shop_id, amount, status)",
+        "CREATE INDEX IF NOT EXISTS idx_match_users_table ON match_users(table_id)",
+        "CREATE INDEX IF NOT EXISTS idx_notes_user_time ON notes(user_id, time)",
+        "CREATE INDEX IF NOT EXISTS idx_shops_owner ON shops(owner_id)",
+        "CREATE INDEX IF NOT EXISTS idx_shops_open ON shops(open, approved)",
+    ],
+    # v3：記事本改用整數日期 day（YYYYMMDD）+ 每月合計 note_months
+    [
+        "ALTER TABLE notes ADD COLUMN day INT",
+        # 舊資料的 time 是 'YYYY-MM-DD' 文字；格式不對的留 NULL（不會出現在月報表）
+        """
+        UPDATE notes SET day = CAST(replace(substr(time, 1, 10), '-', '') AS INT)
+        WHERE time GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+        """,
+        "DROP INDEX IF EXISTS idx_notes_user_time",
+        "CREATE INDEX IF NOT EXISTS idx_notes_user_day ON notes(user_id, day)",
+        """
+        CREATE TABLE IF NOT EXISTS note_months(
+            user_id TEXT,
+            month INT,
+            total INT,
+            count INT,
+            PRIMARY KEY(user_id, month)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT OR REPLACE INTO note_months(user_id, month, total, count)
+        SELECT user_id, day / 100, SUM(amount), COUNT(*) FROM notes
+        WHERE day IS NOT NULL GROUP BY user_id, day / 100
+        """,
+    ],
+    # v4：多 worker 協調（排程 leader lease、快取版本號）
+    [
+        """
+        CREATE TABLE IF NOT EXISTS leases(
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            expires REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS cache_versions(
+            name TEXT PRIMARY KEY,
+            version INT NOT NULL
+        )
+        """,
+    ],
+    # v5：session_state 存整個流程狀態（mode + 其他欄位 JSON）並加上到期時間
+    [
+        "ALTER TABLE session_state ADD COLUMN mode TEXT",
+        "ALTER TABLE session_state ADD COLUMN data TEXT",
+        "ALTER TABLE session_state ADD COLUMN expires REAL",
+        lambda db: db.execute("UPDATE session_state SET expires = COALESCE(updated, 0) + ?", (SESSION_TTL,)),
+        "CREATE INDEX IF NOT EXISTS idx_session_expires ON session_state(expires)",
+    ],
+    # v6：整池配桌一次開很多桌，每桌取下一個桌號（MAX(table_index)）不能每次掃整張 tables
+    [
+        "CREATE INDEX IF NOT EXISTS idx_tables_shop_index ON tables(shop_id, table_index)",
+    ],
+    # v7：配桌成功的桌留一筆紀錄（players = [[user_id, people], ...] JSON），舊的由背景維護封存
+    [
+        """
+        CREATE TABLE IF NOT EXISTS match_history(
+            table_id TEXT PRIMARY KEY,
+            shop_id TEXT,
+            amount TEXT,
+            table_index INT,
+            finished REAL,
+            players TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_match_history_finished ON match_history(finished)",
+    ],
+    # v8：店家選單分頁 / 店名開頭搜尋（索引最後一欄隱含 rowid，(name, rowid) 可以直接當 keyset）
+    [
+        "CREATE INDEX IF NOT EXISTS idx_shops_name ON shops(name)",
+        "CREATE INDEX IF NOT EXISTS idx_shops_approved_name ON shops(approved, name)",
+    ],
+    # v9：店家座標（找附近店家用；空間索引是記憶體裡的 ShopGrid，DB 只存值）
+    [
+        "ALTER TABLE shops ADD COLUMN lat REAL",
+        "ALTER TABLE shops ADD COLUMN lng REAL",
+    ],
+    # v10：各 worker 最近一次處理事件的時間（背景維護判斷「安靜」要看全部 worker，不是只看 leader 自己）
+    [
+        """
+        CREATE TABLE IF NOT EXISTS activity(
+            name TEXT PRIMARY KEY,
+            at REAL
+        )
+        """,
+    ],
+]
 
 
 def init_db():
     db = get_db()
+    if db.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+        return
+    # BEGIN IMMEDIATE：多個 worker 同時啟動時只有一個會真的跑 migration
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        for v, steps in enumerate(MIGRATIONS, 1):
+            if v <= version:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute(f"PRAGMA user_version={v}")
+            print(f"db migrated to v{v}")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
 
-    db.execute("""
-    CREATE TABLE IF NOT EXISTS match_users(
-        user_id TEXT PRIMARY KEY,
-        people INT,
-        shop_id TEXT,
-        amount TEXT,
-        status TEXT,
-        expire REAL,
-        table_id TEXT,
-        table_index INT
-    )
-    """)
 
-    db.execute("""
-    CREATE TABLE IF NOT EXISTS tables(
-        id TEXT PRIMARY KEY,
-        shop_id TEXT,
-        amount TEXT,
-        table_index INT,
-        created REAL,
-        r20 INT DEFAULT 0,
-        r10 INT DEFAULT 0
-    )
-    """)
+# ===== 多 worker 協調 =====
+# cache_versions：寫入方在同一個交易內把對應名稱的版本 +1；
+# 其他 worker 讀快取前比對版本，不一樣就重載（自己寫的那次不會觸發重載）。
+# 單一 worker 模式不查也不寫，行為跟原本一樣。
 
-    db.execute("""
-    CREATE TABLE IF NOT EXISTS notes(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT,
-        content TEXT,
-        amount INT,
-        time TEXT
-    )
-    """)
+class SharedVersions:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.seen = {}  # name -> 目前記憶體內容對應的版本
 
-    db.execute("""
-    CREATE TABLE IF NOT EXISTS shops(
-        shop_id TEXT PRIMARY KEY,
-        name TEXT,
-        open INT,
-        approved INT,
-        group_link TEXT,
-        owner_id TEXT,
-        partner_map TEXT
-    )
-    """)
+    def bump(self, db, name):
+        if not self.enabled:
+            return
+        v = db.execute("""
+            INSERT INTO cache_versions(name, version) VALUES(?, 1)
+            ON CONFLICT(name) DO UPDATE SET version=version+1
+            RETURNING version
+        """, (name,)).fetchone()[0]
+        # 同一交易內同名可能 +1 好幾次，只看第一次：中間沒有別人寫過（已持有寫入鎖，判斷是準的）
+        # -> commit 後把最後的版本視為已看過，自己這次寫入不會讓自己重載
+        uow = getattr(_db_local, "uow", None)
+        mine = uow.setdefault("versions", {}) if uow is not None else {}
+        if name in mine:
+            if mine[name] is not None:
+                mine[name] = v
+            return
+        with self.lock:
+            prev = self.seen.get(name, 0)
+        if prev == v - 1:
+            mine[name] = v
+            after_commit(lambda: self._saw(name, mine[name]))
+        else:
+            mine[name] = None
+
+    def _saw(self, name, v):
+        with self.lock:
+            if self.seen.get(name, 0) < v:
+                self.seen[name] = v
+
+    def changed(self, db, name):
+        if not self.enabled:
+            return False
+        row = db.execute("SELECT version FROM cache_versions WHERE name=?", (name,)).fetchone()
+        v = row[0] if row else 0
+        with self.lock:
+            if self.seen.get(name, 0) == v:
+                return False
+            self.seen[name] = v
+        return True
+
+
+versions = SharedVersions(MULTI_WORKER)
+
+
+class Lease:
+    # SQLite lease：同一個 name 同時只會有一個 owner；owner 沒續約超過 ttl 就可被別人接手
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def renew(self, db):
+        now = time.time()
+        cur = db.execute("""
+            INSERT INTO leases(name, owner, expires) VALUES(?,?,?)
+            ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires=excluded.expires
+            WHERE leases.owner=excluded.owner OR leases.expires < ?
+        """, (self.name, self.owner, now + self.ttl, now))
+        db.commit()
+        return cur.rowcount == 1
 
-    db.execute("""
-    CREATE TABLE IF NOT EXISTS nicknames(
-        user_id TEXT PRIMARY KEY,
-        nickname TEXT
-    )
-    """)
+    def release(self, db):
+        db.execute("UPDATE leases SET expires=0 WHERE name=? AND owner=?", (self.name, self.owner))
+        db.commit()
 
-    # 使用者流程暫存（避免多進程/重啟造成記憶體 user_state 遺失）
-    db.execute("""
-    CREATE TABLE IF NOT EXISTS session_state(
-        user_id TEXT PRIMARY KEY,
-        shop_id TEXT,
-        amount TEXT,
-        updated REAL
-    )
-    """)
 
-    db.commit()
+# ===== 使用者流程狀態（session）=====
+# 取代原本記憶體 user_state + session_state 兩套：一個 session 就是一個 dict（mode / shop_id / amount / sid ...），
+# 寫入一律 write-through 到 session_state（跟事件同一個交易），記憶體只是 LRU + TTL 快取，commit 後才更新。
+# 沒有流程中的使用者也快取成 {}，一般指令不必每次查 DB。
+# 多 worker 時別的 worker 可能改過，讀取一律查 DB（主鍵查詢），不用快取。
+# 閒置超過 SESSION_TTL 視同沒有；過期列由排程定期刪掉。
+
+SESSION_COLUMNS = ("mode", "shop_id", "amount")
+
+
+class SessionStore:
+    def __init__(self, size, ttl, use_cache):
+        self.size = size
+        self.ttl = ttl
+        self.use_cache = use_cache
+        self.lock = threading.Lock()
+        self.data = OrderedDict()  # user_id -> (state, expires)
+
+    def _cached(self, user_id, now):
+        with self.lock:
+            hit = self.data.get(user_id)
+            if hit is None:
+                return None
+            if hit[1] <= now:
+                del self.data[user_id]
+                return None
+            self.data.move_to_end(user_id)
+            return hit[0]
+
+    def _store(self, user_id, state, expires):
+        with self.lock:
+            self.data[user_id] = (state, expires)
+            self.data.move_to_end(user_id)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def _stage(self, user_id, state, expires):
+        # 交易中先拿掉快取（同交易後續讀取會查 DB，看得到自己還沒 commit 的寫入），commit 後再放回
+        if not self.use_cache:
+            return
+        with self.lock:
+            self.data.pop(user_id, None)
+        after_commit(lambda: self._store(user_id, state, expires))
+
+    def get(self, db, user_id):
+        now = time.time()
+        if self.use_cache:
+            state = self._cached(user_id, now)
+            if state is not None:
+                return dict(state)
+        row = db.execute(
+            "SELECT mode, shop_id, amount, data, expires FROM session_state WHERE user_id=?",
+            (user_id,)
+        ).fetchone()
+        state, expires = {}, now + self.ttl
+        if row and (row["expires"] or 0) > now:
+            state = json.loads(row["data"]) if row["data"] else {}
+            for col in SESSION_COLUMNS:
+                if row[col] is not None:
+                    state[col] = row[col]
+            expires = row["expires"]
+        if self.use_cache and not db.in_transaction:
+            self._store(user_id, state, expires)
+        return dict(state)
+
+    def put(self, db, user_id, state):
+        # 整個取代（跟原本 user_state[user_id] = {...} 一樣）
+        now = time.time()
+        extra = {k: v for k, v in state.items() if k not in SESSION_COLUMNS}
+        db.execute("""
+            INSERT INTO session_state(user_id, mode, shop_id, amount, data, updated, expires) VALUES(?,?,?,?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                mode=excluded.mode, shop_id=excluded.shop_id, amount=excluded.amount,
+                data=excluded.data, updated=excluded.updated, expires=excluded.expires
+        """, (
+            user_id, state.get("mode"), state.get("shop_id"), state.get("amount"),
+            json.dumps(extra, ensure_ascii=False) if extra else None, now, now + self.ttl
+        ))
+        commit(db)
+        self._stage(user_id, dict(state), now + self.ttl)
 
+    def clear(self, db, user_id):
+        now = time.time()
+        if self.use_cache and self._cached(user_id, now) == {}:
+            return
+        db.execute("DELETE FROM session_state WHERE user_id=?", (user_id,))
+        commit(db)
+        self._stage(user_id, {}, now + self.ttl)
 
+    def sweep(self, db):
+        now = time.time()
+        with self.lock:
+            for uid in [u for u, (_s, ex) in self.data.items() if ex <= now]:
+                del self.data[uid]
+        n = db.execute("DELETE FROM session_state WHERE expires <= ?", (now,)).rowcount
+        commit(db)
+        return n
 
-def ss_set(db, user_id, shop_id=None, amount=None):
-    now = time.time()
-    row = db.execute("SELECT user_id, shop_id, amount FROM session_state WHERE user_id=?", (user_id,)).fetchone()
-    cur_shop = row["shop_id"] if row else None
-    cur_amt = row["amount"] if row else None
-    if shop_id is None:
-        shop_id = cur_shop
-    if amount is None:
-        amount = cur_amt
-    db.execute(
-        "INSERT OR REPLACE INTO session_state(user_id, shop_id, amount, updated) VALUES(?,?,?,?)",
-        (user_id, shop_id, amount, now)
-    )
-    db.commit()
 
-def ss_get(db, user_id):
-    row = db.execute("SELECT shop_id, amount FROM session_state WHERE user_id=?", (user_id,)).fetchone()
-    if not row:
-        return (None, None)
-    return (row["shop_id"], row["amount"])
+sessions = SessionStore(SESSION_CACHE_SIZE, SESSION_TTL, use_cache=not MULTI_WORKER)
+
+
+# ===== 訊息樣板 =====
+# 固定的選單/提示在啟動時就組好並轉成 dict；SDK 送出前只會呼叫 as_json_dict()，
+# 直接回傳這份 dict，不必每次重建 QuickReply/QuickReplyButton 物件樹再序列化一次。
+# 會變的部分（店家清單、桌況文字）用 text_msg / picker 套進預先序列化好的按鈕骨架。
+# 注意：樣板 dict 會被多個請求共用，只能讀不能改。
+
+class Prebuilt:
+    __slots__ = ("payload",)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def as_json_dict(self):
+        return self.payload
+
+
+# 按鈕直接組成 SDK 序列化後的格式（等同 QuickReplyButton(action=...).as_json_dict()），
+# 動態清單（店家列表）每次也只是幾個小 dict。
+def button(label, text):
+    return {"type": "action", "action": {"type": "message", "label": label, "text": text}}
+
+def postback_button(label, data):
+    return {"type": "action", "action": {"type": "postback", "label": label, "data": data}}
+
+def uri_button(label, uri):
+    return {"type": "action", "action": {"type": "uri", "label": label, "uri": uri}}
+
+def location_button(label):
+    # 開啟 LINE 的位置選擇畫面，送出後是 LocationMessage
+    return {"type": "action", "action": {"type": "location", "label": label}}
+
+
+BTN_BACK = button("🔙 回主選單", "選單")
+
 
-def ss_clear(db, user_id):
-    db.execute("DELETE FROM session_state WHERE user_id=?", (user_id,))
-    db.commit()
+def quick_reply(*buttons):
+    return {"items": list(buttons)}
 
 
-def back_menu():
-    return QuickReply(items=[
-        QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單"))
-    ])
+def picker(buttons):
+    # 動態清單 + 固定的「回主選單」
+    return {"items": list(buttons) + [BTN_BACK]}
 
-def confirm_menu():
-    # 成桌確認階段：提供加入/放棄（避免被後續訊息蓋掉按鍵）
-    return QuickReply(items=[
-        QuickReplyButton(action=MessageAction(label="✅ 加入", text="加入")),
-        QuickReplyButton(action=MessageAction(label="❌ 放棄", text="放棄")),
-        QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-    ])
+
+def text_msg(text, quick_reply=None):
+    payload = {"type": "text", "text": text}
+    if quick_reply is not None:
+        payload["quickReply"] = quick_reply
+    return Prebuilt(payload)
+
+
+QR_BACK = quick_reply(BTN_BACK)
+
+# 成桌確認階段：提供加入/放棄（避免被後續訊息蓋掉按鍵）
+QR_CONFIRM = quick_reply(
+    button("✅ 加入", "加入"),
+    button("❌ 放棄", "放棄"),
+    BTN_BACK,
+)
+
+QR_MATCH_STATUS = quick_reply(
+    button("❌ 取消配桌", "取消配桌"),
+    BTN_BACK,
+)
+
+QR_MATCHING = quick_reply(
+    button("🔍 查看進度", "查看進度"),
+    button("❌ 取消配桌", "取消配桌"),
+    BTN_BACK,
+)
+
+QR_SHOP_OWNER = quick_reply(
+    button("🟢 開始營業", "開始營業"),
+    button("🔴 今日休息", "今日休息"),
+    button("🔗 設定群組", "設定群組"),
+    button("📍 設定位置", "設定位置"),
+    BTN_BACK,
+)
+
+BTN_NEARBY = location_button("📍 附近店家")
+QR_SEND_LOCATION = quick_reply(location_button("📍 傳送位置"), BTN_BACK)
+
+_MAIN_BUTTONS = [
+    button("🀄 店家配桌", "店家配桌"),
+    button("📒 記事本", "記事本"),
+    button("🏷 設定暱稱", "設定暱稱"),
+    button("🗺 店家地圖", "店家地圖"),
+    button("🤝 店家合作", "店家合作"),
+]
+MAIN_MENU = text_msg("請選擇功能", quick_reply(*_MAIN_BUTTONS))
+MAIN_MENU_ADMIN = text_msg("請選擇功能", quick_reply(*_MAIN_BUTTONS, button("6️⃣ 店家管理", "店家管理")))
+
+AMOUNT_PICKER = text_msg("請選擇金額", picker([
+    button("50/20", "金額:50/20"),
+    button("100/20", "金額:100/20"),
+    button("100/50", "金額:100/50"),
+    button("200/50", "金額:200/50"),
+]))
+
+PEOPLE_PICKER = text_msg("請選擇人數", picker([
+    button("我1人", "人數:1"),
+    button("我2人", "人數:2"),
+    button("我3人", "人數:3"),
+    button("我4人", "人數:4"),
+]))
+
+ADMIN_MENU = text_msg("🛠 店家管理", picker([
+    button("📋 查看店家", "管理:查看"),
+    button("✅ 審核店家", "管理:審核"),
+    button("🗑 刪除店家", "管理:刪除"),
+    button("🗺 地圖設定", "管理:地圖設定"),
+]))
+
+ADMIN_REVIEW = text_msg("請選擇審核結果", picker([
+    button("✅ 通過", "管理:同意"),
+    button("❌ 不通過", "管理:不同意"),
+]))
+
+NOTE_MENU = text_msg("📒 記事本", picker([
+    button("➕ 新增紀錄", "新增紀錄"),
+    button("📅 查看當月", "查看當月"),
+    button("⏪ 查看上月", "查看上月"),
+    button("🧹 清除紀錄", "清除紀錄"),
+]))
+
+MATCH_EXISTING = text_msg("你目前已有配桌紀錄\n(可查看進度/取消配桌)", QR_MATCHING)
+MATCH_CONFIRMING = text_msg("你目前在成桌確認中，請選擇：", QR_CONFIRM)
+MATCH_JOINED = text_msg("✅ 已加入配桌等待中", QR_MATCHING)
 
 
 def table_quick_reply(db, table_id):
     # ✅ 以「倒數時間 expire」為準：只要未到期，就固定顯示加入/放棄，避免按鈕閃退/被覆蓋
     if not table_id:
-        return back_menu()
+        return QR_BACK
 
     erow = db.execute(
         "SELECT MIN(expire) AS ex FROM match_users WHERE table_id=? AND expire IS NOT NULL",
@@ -172,40 +987,239 @@ def table_quick_reply(db, table_id):
     if erow and erow["ex"]:
         remain = int(erow["ex"] - time.time())
         if remain > 0:
-            return confirm_menu()
-
-    return back_menu()
-
-
-
-def get_nickname(db, user_id):
-    row = db.execute("SELECT nickname FROM nicknames WHERE user_id=?", (user_id,)).fetchone()
-    return row["nickname"] if row and row["nickname"] else None
-
-
-def display_name(db, user_id):
-    nk = get_nickname(db, user_id)
-    if nk:
-        return nk
-    # 若未設定暱稱，用「玩家XXXX」末4碼
-    return f"玩家{user_id[-4:]}"
+            return QR_CONFIRM
+
+    return QR_BACK
+
+
+
+# ===== 暱稱快取 =====
+# LRU；沒設定暱稱的也快取（存 None），桌況每次重組不必逐位查 nicknames。
+# 「設定暱稱」寫入 commit 後清掉該使用者。
+
+class NicknameCache:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.data = OrderedDict()  # user_id -> nickname / None
+
+    def get_many(self, db, user_ids):
+        if versions.changed(db, "nicknames"):
+            with self.lock:
+                self.data.clear()
+        out = {}
+        miss = []
+        with self.lock:
+            for uid in user_ids:
+                if uid in self.data:
+                    self.data.move_to_end(uid)
+                    out[uid] = self.data[uid]
+                elif uid not in miss:
+                    miss.append(uid)
+        if not miss:
+            return out
+        found = {}
+        for i in range(0, len(miss), 500):
+            chunk = miss[i:i + 500]
+            rows = db.execute(
+                f"SELECT user_id, nickname FROM nicknames WHERE user_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            for r in rows:
+                found[r["user_id"]] = r["nickname"] or None
+        with self.lock:
+            for uid in miss:
+                nk = found.get(uid)
+                out[uid] = nk
+                self.data[uid] = nk
+                self.data.move_to_end(uid)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+        return out
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.data.pop(user_id, None)
+
+
+nickname_cache = NicknameCache(NICKNAME_CACHE_SIZE)
+
+
+def display_names(db, user_ids):
+    # 一次查完整桌（快取沒中的才用一個 IN 查詢補）；未設定暱稱用「玩家XXXX」末4碼
+    nicks = nickname_cache.get_many(db, user_ids)
+    return {uid: nicks.get(uid) or f"玩家{uid[-4:]}" for uid in user_ids}
 
 
 def main_menu(user_id=None):
-    items = [
-        QuickReplyButton(action=MessageAction(label="🀄 店家配桌", text="店家配桌")),
-        QuickReplyButton(action=MessageAction(label="📒 記事本", text="記事本")),
-        QuickReplyButton(action=MessageAction(label="🏷 設定暱稱", text="設定暱稱")),
-        QuickReplyButton(action=MessageAction(label="🗺 店家地圖", text="店家地圖")),
-        QuickReplyButton(action=MessageAction(label="🤝 店家合作", text="店家合作")),
-    ]
-    if user_id in ADMIN_IDS:
-        items.append(QuickReplyButton(action=MessageAction(label="6️⃣ 店家管理", text="店家管理")))
-    return TextSendMessage("請選擇功能", quick_reply=QuickReply(items=items))
+    return MAIN_MENU_ADMIN if user_id in ADMIN_IDS else MAIN_MENU
+
+
+# ===== 店家目錄快取 =====
+# 店家資料很少變動（只有管理員審核/刪除/地圖、店家開關店/群組/申請會寫），
+# 讀取一律走記憶體；寫入路徑在 commit 後呼叫 shop_dir.bump()，下次讀取時才整批重載。
+
+class ShopDirectory:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0          # 每次寫入 +1
+        self.loaded_version = -1  # 目前快取對應的版本
+        self.shops = {}           # shop_id -> dict
+        self.open_list = []       # 營業中 + 已審核，rowid DESC（新的在前）
+        self.listings = {}        # "open" / "map" -> ShopListing（選單分頁用）
+        self.grid = ShopGrid([], SHOP_GRID_DEG)  # 營業中且有座標的店（找附近店家用）
+
+    def bump(self):
+        with self.lock:
+            self.version += 1
+
+    def _ensure(self, db):
+        if versions.changed(db, "shops"):
+            self.bump()
+        if self.loaded_version == self.version:
+            return
+        with self.lock:
+            version = self.version
+        rows = db.execute("""
+            SELECT rowid, shop_id, name, open, approved, group_link, owner_id, partner_map, lat, lng
+            FROM shops ORDER BY rowid DESC
+        """).fetchall()
+        shops = {r["shop_id"]: dict(r) for r in rows}
+        open_list = [shops[r["shop_id"]] for r in rows if r["open"] == 1 and r["approved"] == 1]
+        listings = {
+            "open": ShopListing(open_list),
+            "map": ShopListing([s for s in open_list if (s["partner_map"] or "").strip()]),
+        }
+        grid = ShopGrid(open_list, SHOP_GRID_DEG)
+        with self.lock:
+            self.shops, self.open_list, self.listings, self.grid = shops, open_list, listings, grid
+            self.loaded_version = version
+
+    def get(self, db, shop_id):
+        self._ensure(db)
+        return self.shops.get(shop_id)
+
+    def get_open(self, db, shop_id):
+        shop = self.get(db, shop_id)
+        return shop if shop and shop["open"] == 1 and shop["approved"] == 1 else None
+
+    def open_shops(self, db):
+        self._ensure(db)
+        return self.open_list
+
+    def page(self, db, source, after=None, prefix=""):
+        self._ensure(db)
+        return self.listings[source].page(SHOP_PAGE_SIZE, after, prefix)
+
+    def nearest(self, db, lat, lng, k=None, max_km=None):
+        self._ensure(db)
+        return self.grid.nearest(lat, lng, k or NEARBY_SHOPS, max_km or NEARBY_MAX_KM)
+
+
+class ShopListing:
+    # 一份店家清單的兩種排序：rowid DESC（新的在前）與 (店名, rowid)；
+    # 翻頁跟店名開頭搜尋都是 bisect 找起點再切一頁，跟店家總數無關。
+    def __init__(self, shops):
+        self.shops = shops
+        self.keys = [-s["rowid"] for s in shops]  # 遞增，給 bisect
+        self.by_name = sorted(shops, key=lambda s: (s["name"] or "", s["rowid"]))
+        self.name_keys = [(s["name"] or "", s["rowid"]) for s in self.by_name]
+
+    def page(self, limit, after=None, prefix=""):
+        # after = 上一頁最後一家的排序鍵：沒搜尋時是 rowid，搜尋時是 (店名, rowid)；
+        # 那家店之後被刪掉 / 關店也照樣接得下去。回傳 (這一頁, 是否還有下一頁)
+        if not prefix:
+            i = bisect.bisect_right(self.keys, -after) if after is not None else 0
+            rows = self.shops[i:i + limit + 1]
+        else:
+            if after is not None:
+                i = bisect.bisect_right(self.name_keys, after)
+            else:
+                i = bisect.bisect_left(self.name_keys, (prefix,))
+            rows = []
+            for s in self.by_name[i:i + limit + 1]:
+                if not (s["name"] or "").startswith(prefix):
+                    break
+                rows.append(s)
+        return rows[:limit], len(rows) > limit
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    # haversine
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 12742.0 * math.asin(min(1.0, math.sqrt(a)))
+
+
+class ShopGrid:
+    # 依經緯度切成 cell_deg 見方的格子；找最近的店從所在格一圈一圈往外找，
+    # 只跟附近幾格裡的店算距離，不用每家店都算。
+    # 第 r 圈找完後，還沒看到的店至少在 r 格以外（r * 每格最短邊的公里數），
+    # 已經湊滿 k 家且第 k 近的比這個距離還近就可以停。
+    def __init__(self, shops, cell_deg):
+        self.cell = cell_deg
+        self.cells = {}
+        self.size = 0
+        for s in shops:
+            if s["lat"] is None or s["lng"] is None:
+                continue
+            self.cells.setdefault(self._key(s["lat"], s["lng"]), []).append(s)
+            self.size += 1
+
+    def _key(self, lat, lng):
+        return int(math.floor(lat / self.cell)), int(math.floor(lng / self.cell))
+
+    def covered_km(self, lat, r):
+        # 找完第 r 圈時保證涵蓋的半徑：經度方向的格子越往高緯度越窄，用這圈最外緣的緯度算；
+        # 再打 0.99 折，因為沿緯線走比大圓距離略長
+        lat_edge = min(89.0, abs(lat) + (r + 1) * self.cell)
+        return r * self.cell * 111.19 * math.cos(math.radians(lat_edge)) * 0.99
+
+    def nearest(self, lat, lng, k, max_km):
+        # 回傳 [(公里, shop), ...]，由近到遠，最多 k 家
+        if not self.size:
+            return []
+        cy, cx = self._key(lat, lng)
+        found = []
+        seen = 0
+        r = 0
+        while True:
+            if r == 0:
+                ring = [(cy, cx)]
+            else:
+                ring = [(cy + dy, cx + dx) for dy in (-r, r) for dx in range(-r, r + 1)]
+                ring += [(cy + dy, cx + dx) for dx in (-r, r) for dy in range(-r + 1, r)]
+            for key in ring:
+                cell = self.cells.get(key, ())
+                seen += len(cell)
+                for s in cell:
+                    d = distance_km(lat, lng, s["lat"], s["lng"])
+                    if d <= max_km:
+                        found.append((d, s["rowid"], s))
+            covered = self.covered_km(lat, r)
+            if len(found) >= k:
+                found.sort(key=lambda x: x[:2])
+                del found[k:]
+                if found[-1][0] <= covered:
+                    break
+            if covered > max_km or seen == self.size:
+                break
+            r += 1
+        found.sort(key=lambda x: x[:2])
+        return [(d, s) for d, _rowid, s in found[:k]]
+
+
+shop_dir = ShopDirectory()
+
+
+def shops_changed():
+    versions.bump(get_db(), "shops")
+    after_commit(shop_dir.bump)
 
 
 def get_group_link(db, shop_id):
-    row = db.execute("SELECT group_link FROM shops WHERE shop_id=?", (shop_id,)).fetchone()
+    row = shop_dir.get(db, shop_id)
     if row and (row["group_link"] or "").strip():
         return row["group_link"].strip()
     return SYSTEM_GROUP_LINK
@@ -232,6 +1246,7 @@ def build_table_status_msg(db, table_id, title="🀄 桌況更新"):
     if not rows:
         return None
 
+    names = display_names(db, [r["user_id"] for r in rows])
     total = sum(int(r["people"]) for r in rows)
     confirmed = sum(1 for r in rows if r["status"] == "confirmed")
 
@@ -251,105 +1266,580 @@ def build_table_status_msg(db, table_id, title="🀄 桌況更新"):
             icon = "⏳"
             st_label = st
 
-        msg += f"{i}. {display_name(db, r['user_id'])}｜{int(r['people'])}人 {icon} {st_label}\n"
+        msg += f"{i}. {names[r['user_id']]}｜{int(r['people'])}人 {icon} {st_label}\n"
 
     return msg.strip()
 
 
-def push_table(table_id, title="🀄 桌況更新"):
-    with app.app_context():
-        db = get_db()
-        msg = build_table_status_msg(db, table_id, title)
-        if not msg:
+# ===== 推播派送（背景佇列）=====
+# 推播一律丟進佇列由背景 worker 送出，不卡 webhook / 排程執行緒。
+# 同一則訊息給多人時用 multicast 一次送；同一個 key（通常是 table_id）固定由同一個 worker 處理，維持先後順序。
+
+MULTICAST_MAX = 500  # LINE multicast 單次上限
+
+
+class PushDispatcher:
+    def __init__(self, workers):
+        self.queues = [queue.Queue() for _ in range(max(1, workers))]
+        self.started = False
+        self.local = threading.local()
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        for q in self.queues:
+            threading.Thread(target=self._worker, args=(q,), daemon=True).start()
+
+    def send(self, key, user_ids, messages, tag="push"):
+        ids = list(dict.fromkeys(u for u in user_ids if u))
+        if not ids:
             return
-        for uid in get_table_users(db, table_id):
+        q = self.queues[hash(key) % len(self.queues)]
+        for i in range(0, len(ids), MULTICAST_MAX):
+            q.put((ids[i:i + MULTICAST_MAX], messages, tag))
+
+    def join(self):
+        for q in self.queues:
+            q.join()
+
+    def _worker(self, q):
+        while True:
+            ids, messages, tag = q.get()
+            try:
+                self._deliver(ids, messages, tag)
+            finally:
+                q.task_done()
+
+    def _client(self):
+        # SDK 把 retry_key 寫進 client 的 headers 而且不會清掉：共用 line_bot_api 的話
+        # 各 worker 會互相蓋掉 key，之後的 reply 也會帶著舊 key。每個 worker 用一份自己 headers 的複本。
+        if not isinstance(line_bot_api, LineBotApi):
+            return line_bot_api  # 本機 stub
+        if getattr(self.local, "base", None) is not line_bot_api:
+            api = copy.copy(line_bot_api)
+            api.headers = dict(line_bot_api.headers)
+            self.local.base, self.local.api = line_bot_api, api
+        return self.local.api
+
+    def _deliver(self, ids, messages, tag):
+        api = self._client()
+        try:
+            self._send(api, ids, messages, tag)
+        finally:
+            headers = getattr(api, "headers", None)
+            if isinstance(headers, dict):
+                headers.pop("X-Line-Retry-Key", None)
+
+    def _send(self, api, ids, messages, tag):
+        # retry_key 讓 LINE 端把重送視為同一次請求，避免 5xx 重試造成重複訊息
+        retry_key = str(uuid.uuid4())
+        for attempt in range(PUSH_MAX_RETRY + 1):
             try:
-                line_bot_api.push_message(uid, TextSendMessage(msg, quick_reply=table_quick_reply(db, table_id)))
+                if len(ids) == 1:
+                    call_line_api("push_message", ids[0], messages, api=api, retry_key=retry_key)
+                else:
+                    call_line_api("multicast", ids, messages, api=api, retry_key=retry_key)
+                return
+            except LineBotApiError as e:
+                if e.status_code == 409 and attempt > 0:
+                    # 這次工作的 retry_key 已被受理（前一次其實送成功了）
+                    return
+                if attempt >= PUSH_MAX_RETRY or not (e.status_code == 429 or e.status_code >= 500):
+                    print(f"{tag} error:", e)
+                    return
+                delay = 0.5 * (2 ** attempt)
+                retry_after = (e.headers or {}).get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                time.sleep(delay)
+            except RequestException as e:
+                if attempt >= PUSH_MAX_RETRY:
+                    print(f"{tag} error:", e)
+                    return
+                time.sleep(0.5 * (2 ** attempt))
             except Exception as e:
-                print("push_table error:", e)
+                print(f"{tag} error:", e)
+                return
 
 
-def notify_table(table_id, text):
-    with app.app_context():
+dispatcher = PushDispatcher(PUSH_WORKERS)
+
+
+# ===== 同桌通知合併 =====
+# 視窗內同一桌的桌況更新只送最新一版，提醒 / 成桌 / 成功等文字接在同一則訊息前面，
+# 玩家收到一則訊息而不是一連串推播。
+
+class TableNotifier:
+    def __init__(self, window_ms):
+        self.window = window_ms / 1000.0
+        self.lock = threading.Lock()
+        self.pending = {}  # table_id -> {"title": 最新桌況標題, "notices": [(text, user_ids), ...]}
+
+    def status(self, table_id, title):
+        self._add(table_id, title=title)
+
+    def notice(self, table_id, text, user_ids):
+        self._add(table_id, notice=(text, tuple(user_ids)))
+
+    def _add(self, table_id, title=None, notice=None):
+        with self.lock:
+            p = self.pending.get(table_id)
+            first = p is None
+            if first:
+                p = self.pending[table_id] = {"title": None, "notices": []}
+            if title:
+                p["title"] = title
+            if notice:
+                p["notices"].append(notice)
+        if not first:
+            return
+        if self.window <= 0:
+            self.flush(table_id)
+        else:
+            scheduler.schedule(time.time() + self.window, ("notify", table_id), self.flush, table_id)
+
+    def flush_all(self):
+        with self.lock:
+            table_ids = list(self.pending)
+        for table_id in table_ids:
+            self.flush(table_id)
+
+    def flush(self, table_id):
+        with self.lock:
+            p = self.pending.pop(table_id, None)
+        if not p:
+            return
         db = get_db()
-        for uid in get_table_users(db, table_id):
-            try:
-                line_bot_api.push_message(uid, TextSendMessage(text, quick_reply=table_quick_reply(db, table_id)))
-            except Exception as e:
-                print("notify_table error:", e)
+        parts = {}  # uid -> [text, ...]
+        for text, uids in p["notices"]:
+            for uid in uids:
+                parts.setdefault(uid, []).append(text)
+        # 桌況在送出當下才組（桌子已結束 / 作廢就不送）
+        status = build_table_status_msg(db, table_id, p["title"]) if p["title"] else None
+        if status:
+            for uid in get_table_users(db, table_id):
+                parts.setdefault(uid, []).append(status)
+        qr = table_quick_reply(db, table_id)
 
+        groups = {}
+        for uid, texts in parts.items():
+            groups.setdefault(tuple(texts), []).append(uid)
+        for texts, uids in groups.items():
+            dispatcher.send(table_id, uids, text_msg("\n\n".join(texts), quick_reply=qr), "notify_table")
 
-def try_make_table(shop_id, amount, reply_token=None, trigger_user_id=None):
-    db = get_db()
-    rows = db.execute("""
-        SELECT user_id, people FROM match_users
-        WHERE shop_id=? AND amount=? AND status='waiting'
-        ORDER BY rowid
-    """, (shop_id, amount)).fetchall()
 
-    total = 0
-    selected = []
-    for r in rows:
-        uid = r["user_id"]
-        p = int(r["people"])
-        if total + p > 4:
-            continue
-        total += p
-        selected.append((uid, p))
-        if total == 4:
-            break
-
-    if total != 4:
-        return None
+notifier = TableNotifier(NOTIFY_COALESCE_MS)
 
-    table_id = f"{shop_id}_{int(time.time()*1000)}"
-    expire = time.time() + COUNTDOWN_READY
-    table_index = get_next_table_index(db, shop_id)
 
-    db.execute(
-        "INSERT INTO tables(id, shop_id, amount, table_index, created, r20, r10) VALUES(?,?,?,?,?,?,?)",
-        (table_id, shop_id, amount, table_index, time.time(), 0, 0)
-    )
+def push_table(table_id, title="🀄 桌況更新"):
+    after_commit(lambda: notifier.status(table_id, title))
 
-    for uid, _p in selected:
-        db.execute("""
+
+def notify_table(table_id, text, user_ids=None):
+    # user_ids：桌子已作廢（玩家已回等待池）時，由呼叫端先取好名單
+    if user_ids is None:
+        user_ids = get_table_users(get_db(), table_id)
+    after_commit(lambda: notifier.notice(table_id, text, user_ids))
+
+
+# ===== 配桌池（記憶體索引）=====
+# 每個 (shop_id, amount) 一個等待池，依人數 1~4 分桶；桶內是 match_users.rowid 由小到大（先到先配）。
+# 寫入一律 write-through：先寫 match_users，再更新記憶體；啟動時由 DB 重建。
+
+# 湊滿 4 人的所有組合：((人數, 組數), ...)
+TABLE_COMBOS = (
+    ((4, 1),),
+    ((3, 1), (1, 1)),
+    ((2, 2),),
+    ((2, 1), (1, 2)),
+    ((1, 4),),
+)
+
+
+def max_tables(counts):
+    # counts：{人數: 組數}，最多湊得出幾桌。
+    # 3 人只能配 1 人；2 人先兩兩一桌，落單的 2 人配兩個 1 人；剩下的 1 人四個一桌。
+    n31 = min(counts[3], counts[1])
+    ones = counts[1] - n31
+    n = counts[4] + n31 + counts[2] // 2
+    if counts[2] % 2 and ones >= 2:
+        n += 1
+        ones -= 2
+    return n + ones // 4
+
+
+class MatchPool:
+    def __init__(self):
+        self.lock = threading.RLock()  # 保護下面三個 dict（每次操作都很短）
+        self.pools = {}    # (shop_id, amount) -> {people: [rowid, ...]}
+        self.members = {}  # user_id -> (pool_key, people, rowid)
+        self.by_seq = {}   # rowid -> user_id
+        self.pool_locks = {}  # (shop_id, amount) -> 成桌用的池鎖
+        self.conflicts = 0    # 成桌時 CAS 失敗（記憶體跟 DB 對不上）次數
+
+    def pool_lock(self, key):
+        with self.lock:
+            lock = self.pool_locks.get(key)
+            if lock is None:
+                lock = self.pool_locks[key] = threading.RLock()
+            return lock
+
+    def load(self, db):
+        rows = db.execute("""
+            SELECT rowid AS seq, user_id, people, shop_id, amount FROM match_users
+            WHERE status='waiting'
+            ORDER BY rowid
+        """).fetchall()
+        with self.lock:
+            self.pools.clear()
+            self.members.clear()
+            self.by_seq.clear()
+            for r in rows:
+                self._add(r["user_id"], r["shop_id"], r["amount"], int(r["people"]), r["seq"])
+
+    def reload(self, db, key):
+        # 單一池由 DB 重建（交易 rollback 後用來丟掉記憶體裡已套用的變更）
+        rows = db.execute("""
+            SELECT rowid AS seq, user_id, people, shop_id, amount FROM match_users
+            WHERE shop_id=? AND amount=? AND status='waiting'
+            ORDER BY rowid
+        """, key).fetchall()
+        with self.lock:
+            for uid in [u for u, m in self.members.items() if m[0] == key]:
+                self._remove(uid)
+            for r in rows:
+                self._add(r["user_id"], r["shop_id"], r["amount"], int(r["people"]), r["seq"])
+
+    def _touch(self, *keys):
+        for key in keys:
+            if key is not None:
+                versions.bump(get_db(), pool_version_name(key))
+                on_rollback(lambda key=key: self.reload(get_db(), key))
+
+    def sync(self, db, key):
+        # 多 worker：別的 worker 動過這個池就先由 DB 重建。
+        # 呼叫端都已經在同一交易內寫過（持有寫入鎖），重建到 commit 之間不會再被別人改。
+        if versions.changed(db, pool_version_name(key)):
+            self.reload(db, key)
+
+    def _key_of(self, user_id):
+        m = self.members.get(user_id)
+        return m[0] if m else None
+
+    def _add(self, user_id, shop_id, amount, people, seq):
+        self._remove(user_id)
+        if people not in (1, 2, 3, 4):
+            return
+        key = (shop_id, amount)
+        buckets = self.pools.get(key)
+        if buckets is None:
+            buckets = self.pools[key] = {1: [], 2: [], 3: [], 4: []}
+        bisect.insort(buckets[people], seq)
+        self.members[user_id] = (key, people, seq)
+        self.by_seq[seq] = user_id
+
+    def _remove(self, user_id):
+        m = self.members.pop(user_id, None)
+        if not m:
+            return
+        key, people, seq = m
+        self.by_seq.pop(seq, None)
+        buckets = self.pools.get(key)
+        if not buckets:
+            return
+        bucket = buckets[people]
+        i = bisect.bisect_left(bucket, seq)
+        if i < len(bucket) and bucket[i] == seq:
+            del bucket[i]
+        if not any(buckets.values()):
+            del self.pools[key]
+
+    def join(self, db, user_id, shop_id, amount, people):
+        # 只取代「等待中」的舊紀錄（重新選店/金額/人數，排到最後）；已在成桌確認中的不動，回傳 False。
+        # 舊的池以 DB 為準（可能是別的 worker 加入的，本機記憶體不知道）
+        old = db.execute(
+            "DELETE FROM match_users WHERE user_id=? AND status='waiting' RETURNING shop_id, amount",
+            (user_id,)
+        ).fetchone()
+        cur = db.execute("""
+            INSERT OR IGNORE INTO match_users(user_id, people, shop_id, amount, status, expire, table_id, table_index)
+            VALUES(?, ?, ?, ?, 'waiting', NULL, NULL, NULL)
+        """, (user_id, people, shop_id, amount))
+        if cur.rowcount != 1:
+            return False
+        commit(db)
+        with self.lock:
+            self._touch(self._key_of(user_id), old and (old["shop_id"], old["amount"]), (shop_id, amount))
+            self._add(user_id, shop_id, amount, int(people), cur.lastrowid)
+        matcher.mark(old and (old["shop_id"], old["amount"]), (shop_id, amount))
+        return True
+
+    def leave(self, db, user_id, status=None):
+        # 回傳被刪掉的那列（shop_id / amount / status / table_id），沒有就 None。
+        # 給 status 就是 CAS：讀到之後狀態若已被別的事件改掉（例如剛被配進一桌）就不刪
+        if status is None:
+            old = db.execute(
+                "DELETE FROM match_users WHERE user_id=? RETURNING shop_id, amount, status, table_id",
+                (user_id,)
+            ).fetchone()
+        else:
+            old = db.execute(
+                "DELETE FROM match_users WHERE user_id=? AND status=? RETURNING shop_id, amount, status, table_id",
+                (user_id, status)
+            ).fetchone()
+        if old is None:
+            return None
+        commit(db)
+        with self.lock:
+            self._touch(self._key_of(user_id), (old["shop_id"], old["amount"]))
+            self._remove(user_id)
+        matcher.mark((old["shop_id"], old["amount"]))
+        return old
+
+    def requeue(self, db, table_id):
+        # 成桌作廢：桌上剩下的玩家回到等待池（保留原本 rowid 的順位）
+        rows = db.execute(
+            "SELECT rowid AS seq, user_id, people, shop_id, amount FROM match_users WHERE table_id=?",
+            (table_id,)
+        ).fetchall()
+        db.execute("UPDATE match_users SET status='waiting', expire=NULL, table_id=NULL, table_index=NULL WHERE table_id=?", (table_id,))
+        commit(db)
+        keys = {(r["shop_id"], r["amount"]) for r in rows}
+        with self.lock:
+            self._touch(*keys)
+            for r in rows:
+                self._add(r["user_id"], r["shop_id"], r["amount"], int(r["people"]), r["seq"])
+        matcher.mark(*keys)
+        return [r["user_id"] for r in rows]
+
+    def take(self, user_ids):
+        with self.lock:
+            self._touch(*{self._key_of(uid) for uid in user_ids})
+            for uid in user_ids:
+                self._remove(uid)
+
+    def pack(self, shop_id, amount, skip_limit, limit=None):
+        # 整池一次排出所有桌（limit：最多排幾桌）：[[(user_id, people, rowid), ...], ...]，不改記憶體（寫進 DB 成功後再 take）。
+        # 每一桌只從各桶最前面拿（同人數一定先來先配）；每一步在 5 種組合裡選：
+        #   照先來後到（排序後 rowid 字典序最小）的那個，若會讓整池少湊一桌，改選「不少湊桌」裡最前面的；
+        #   被這樣跳過的那一組（照順序本來輪得到、卻被後面的插隊）記一次，同一組最多被跳過 skip_limit 次，
+        #   之後輪到它就一律照順序。
+        with self.lock:
+            buckets = self.pools.get((shop_id, amount))
+            if not buckets:
+                return []
+            buckets = {p: list(b) for p, b in buckets.items()}
+            users = {seq: self.by_seq[seq] for b in buckets.values() for seq in b}
+        heads = {1: 0, 2: 0, 3: 0, 4: 0}
+        counts = {p: len(b) for p, b in buckets.items()}
+        plan = []
+        passed = {}  # rowid -> 被插隊次數
+        target = max_tables(counts)
+        while target and (limit is None or len(plan) < limit):
+            fifo = best = None
+            for combo in TABLE_COMBOS:
+                if any(counts[p] < n for p, n in combo):
+                    continue
+                seqs = sorted((seq, p) for p, n in combo for seq in buckets[p][heads[p]:heads[p] + n])
+                if fifo is None or seqs < fifo[0]:
+                    fifo = (seqs, combo)
+                left = dict(counts)
+                for p, n in combo:
+                    left[p] -= n
+                if max_tables(left) == target - 1 and (best is None or seqs < best[0]):
+                    best = (seqs, combo)
+            choice = fifo
+            if best[0] != fifo[0]:
+                # 照順序那一桌裡，第一個沒被選進「不少湊桌」那一桌的人就是被插隊的
+                skipped = next(a for a, b in zip(fifo[0], best[0]) if a != b)[0]
+                if passed.get(skipped, 0) < skip_limit:
+                    passed[skipped] = passed.get(skipped, 0) + 1
+                    choice = best
+            seqs, combo = choice
+            for p, n in combo:
+                heads[p] += n
+                counts[p] -= n
+            plan.append([(users[seq], p, seq) for seq, p in seqs])
+            target = max_tables(counts)
+        return plan
+
+    def sizes(self, shop_id, amount):
+        with self.lock:
+            buckets = self.pools.get((shop_id, amount)) or {}
+            return {p: len(b) for p, b in buckets.items()}
+
+
+match_pool = MatchPool()
+
+
+def pool_version_name(key):
+    return f"pool:{key[0]}:{key[1]}"
+
+
+def seat_table(db, shop_id, amount, selected):
+    # 一桌的寫入包在 savepoint 裡；每位玩家都用 CAS（rowid + status='waiting'）更新，
+    # 任何一位已經不在等待（被別的 worker / 路徑先配走、取消、重新加入）就整段退回，回傳 None
+    table_index = get_next_table_index(db, shop_id)
+    table_id = f"{shop_id}_{int(time.time()*1000)}_{table_index}"
+    expire = time.time() + COUNTDOWN_READY
+    db.execute("SAVEPOINT seat_table")
+    try:
+        db.execute(
+            "INSERT INTO tables(id, shop_id, amount, table_index, created, r20, r10) VALUES(?,?,?,?,?,?,?)",
+            (table_id, shop_id, amount, table_index, time.time(), 0, 0)
+        )
+        cur = db.executemany("""
             UPDATE match_users
             SET status='ready', expire=?, table_id=?, table_index=?
-            WHERE user_id=?
-        """, (expire, table_id, table_index, uid))
+            WHERE rowid=? AND user_id=? AND status='waiting'
+        """, [(expire, table_id, table_index, seq, uid) for uid, _p, seq in selected])
+        if cur.rowcount != len(selected):
+            db.execute("ROLLBACK TO seat_table")
+            db.execute("RELEASE seat_table")
+            return None
+    except Exception:
+        db.execute("ROLLBACK TO seat_table")
+        db.execute("RELEASE seat_table")
+        raise
+    db.execute("RELEASE seat_table")
+    return table_id, table_index, expire
 
-    db.commit()
 
-    msg = (
-        "🎉 成桌確認\n"
-        f"🪑 桌號：{table_index}\n"
-        f"💰 金額：{amount}\n\n"
-        f"⏱ {COUNTDOWN_READY} 秒內未確認視同放棄"
-    )
+def try_make_table(shop_id, amount, reply_token=None, trigger_user_id=None):
+    # 整池配桌：湊得出幾桌就開幾桌（MatchPool.pack），全部在同一個交易裡。
+    # 回傳觸發者被配進的桌號；沒有觸發者時回傳第一桌；一桌都沒成回傳 None。
+    db = get_db()
+    key = (shop_id, amount)
+    # 鎖的順序固定：先拿 DB 寫入鎖（BEGIN IMMEDIATE；事件裡通常前面已經寫過、早就持有），再拿池鎖，
+    # 不會出現「拿著池鎖等 DB、拿著 DB 等池鎖」的互等。同一池的挑人→寫入→移出記憶體整段序列化，
+    # 不同池各自一把鎖，記憶體操作互不阻塞。
+    if not db.in_transaction:
+        db.execute("BEGIN IMMEDIATE")
+    formed = []  # [(selected, (table_id, table_index, expire)), ...]
+    with match_pool.pool_lock(key):
+        matcher.clean(key)  # 整池都會評估到；持有寫入鎖期間別人也改不了這個池
+        for _attempt in range(3):
+            match_pool.sync(db, key)
+            stale = False
+            for selected in match_pool.pack(shop_id, amount, MATCH_SKIP_LIMIT):
+                seated = seat_table(db, shop_id, amount, selected)
+                if not seated:
+                    stale = True
+                    break
+                match_pool.take([uid for uid, _p, _seq in selected])
+                formed.append((selected, seated))
+            if not stale:
+                break
+            # 記憶體比 DB 舊：以 DB 重建這個池，剩下的再排一次（已開成的桌不動）
+            with match_pool.lock:
+                match_pool.conflicts += 1
+            metrics.inc("mahjong_match_conflicts_total")
+            match_pool.reload(db, key)
+        commit(db)
+    if not formed:
+        return None
 
-    qr = QuickReply(items=[
-        QuickReplyButton(action=MessageAction(label="✅ 加入", text="加入")),
-        QuickReplyButton(action=MessageAction(label="❌ 放棄", text="放棄")),
-        QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-    ])
+    result = None
+    for selected, (table_id, table_index, expire) in formed:
+        # 等 transaction 真的 commit 了才排倒數；rollback 的桌子不能留下計時
+        after_commit(lambda table_id=table_id, expire=expire: schedule_table(table_id, expire))
+        msg = (
+            "🎉 成桌確認\n"
+            f"🪑 桌號：{table_index}\n"
+            f"💰 金額：{amount}\n\n"
+            f"⏱ {COUNTDOWN_READY} 秒內未確認視同放棄"
+        )
 
-    for uid, _p in selected:
-        try:
+        others = []
+        for uid, _p, _seq in selected:
             if reply_token and trigger_user_id and uid == trigger_user_id:
-                line_bot_api.reply_message(reply_token, TextSendMessage(msg, quick_reply=qr))
+                reply(reply_token, text_msg(msg, quick_reply=QR_CONFIRM))
+                result = table_id
             else:
-                line_bot_api.push_message(uid, TextSendMessage(msg, quick_reply=qr))
-        except Exception as e:
-            print("confirm push error:", e)
-
-    push_table(table_id, "🪑 桌子成立（等待確認）")
-    return table_id
-
+                others.append(uid)
+        notify_table(table_id, msg, user_ids=others)
+
+        push_table(table_id, "🪑 桌子成立（等待確認）")
+    if result is None and not trigger_user_id:
+        result = formed[0][1][0]
+    return result
+
+
+
+# ===== 待配桌的池（dirty set）=====
+# 加入 / 取消 / 放棄 / 到期只把動到的 (shop_id, amount) 記下來，由 matcher 在排程執行緒上整批重新配桌：
+# 只評估真的有變動的池、不掃其他池；同一段時間內同一池被動很多次也只評估一次。
+# 玩家自己選完人數時仍直接 try_make_table（成桌訊息才能用 reply 送），評估過的池會從 dirty 拿掉。
+
+class Matcher:
+    def __init__(self, delay_ms, batch):
+        self.delay = delay_ms / 1000.0
+        self.batch = max(1, batch)
+        self.lock = threading.Lock()
+        self.dirty = OrderedDict()  # (shop_id, amount) -> None，先變動的先處理
+        self.scheduled = False
+
+    def mark(self, *keys):
+        with self.lock:
+            for key in keys:
+                if key is not None:
+                    self.dirty[key] = None
+            if self.scheduled or not self.dirty:
+                return
+            self.scheduled = True
+        scheduler.schedule(time.time() + self.delay, ("match",), self.drain)
+
+    def clean(self, key):
+        with self.lock:
+            self.dirty.pop(key, None)
+
+    def pending(self):
+        with self.lock:
+            return len(self.dirty)
+
+    def drain(self):
+        # 在 unit_of_work 裡跑（排程執行緒）；一輪最多 batch 個池，還有剩就馬上再排一輪
+        # scheduled 在整輪處理完之前都保持 True，中途 mark 的池只會進 dirty，由 finally 再排下一輪
+        with self.lock:
+            keys = []
+            while self.dirty and len(keys) < self.batch:
+                keys.append(self.dirty.popitem(last=False)[0])
+        ok = False
+        try:
+            for key in keys:
+                try_make_table(*key)
+            ok = True
+        finally:
+            with self.lock:
+                if not ok:
+                    # 這一輪的交易會整個 rollback（已經處理的池也一樣），全部放回最前面重來
+                    for key in reversed(keys):
+                        self.dirty[key] = None
+                        self.dirty.move_to_end(key, last=False)
+                more = self.scheduled = bool(self.dirty)
+            if more:
+                # 失敗（例如 database is locked）時隔一秒再試，不要原地打轉
+                scheduler.schedule(time.time() + (0 if ok else max(1.0, self.delay)), ("match",), self.drain)
+        if keys:
+            metrics.inc("mahjong_match_cycles_total")
+            metrics.inc("mahjong_match_pools_evaluated_total", len(keys))
+            metrics.observe("mahjong_match_cycle_pools", len(keys))
+
+    def flush(self):
+        # 不等排程，直接把目前所有 dirty 池處理完（壓測收尾用）
+        while self.pending():
+            with unit_of_work():
+                self.drain()
+
+
+matcher = Matcher(MATCH_DELAY_MS, MATCH_BATCH_POOLS)
 
 def finalize_success(table_id, skip_user_id=None):
     db = get_db()
+    # 先刪桌子當作認領：同時有兩位玩家按加入、或到期處理同時進來，只有一邊會成功
     trow = db.execute(
-        "SELECT shop_id, amount, table_index FROM tables WHERE id=?",
+        "DELETE FROM tables WHERE id=? RETURNING shop_id, amount, table_index",
         (table_id,)
     ).fetchone()
     if not trow:
@@ -359,7 +1849,7 @@ def finalize_success(table_id, skip_user_id=None):
     amount = trow["amount"]
     table_index = trow["table_index"]
 
-    shop = db.execute("SELECT name, group_link FROM shops WHERE shop_id=?", (shop_id,)).fetchone()
+    shop = shop_dir.get(db, shop_id)
     shop_name = shop["name"] if shop and shop["name"] else "店家"
     group = (shop["group_link"] if shop and shop["group_link"] else None) or SYSTEM_GROUP_LINK
 
@@ -375,18 +1865,18 @@ def finalize_success(table_id, skip_user_id=None):
     )
 
     # 推播給其他已確認者（觸發者用 reply 送，避免同一事件重複 reply）
-    for r in rows:
-        uid = r["user_id"]
-        if skip_user_id and uid == skip_user_id:
-            continue
-        try:
-            line_bot_api.push_message(uid, TextSendMessage(msg, quick_reply=back_menu()))
-        except Exception as e:
-            print("success push error:", e)
+    others = [r["user_id"] for r in rows if not (skip_user_id and r["user_id"] == skip_user_id)]
+    notify_table(table_id, msg, user_ids=others)
 
+    players = db.execute("SELECT user_id, people FROM match_users WHERE table_id=? ORDER BY rowid", (table_id,)).fetchall()
+    db.execute(
+        "INSERT OR REPLACE INTO match_history(table_id, shop_id, amount, table_index, finished, players) VALUES(?,?,?,?,?,?)",
+        (table_id, shop_id, amount, table_index, time.time(), json.dumps([[r["user_id"], r["people"]] for r in players]))
+    )
     db.execute("DELETE FROM match_users WHERE table_id=?", (table_id,))
-    db.execute("DELETE FROM tables WHERE id=?", (table_id,))
-    db.commit()
+    commit(db)
+    # rollback 時桌子會回來，計時也得留著，所以 commit 後才取消
+    after_commit(lambda: scheduler.cancel(table_id))
 
     return msg
 
@@ -394,7 +1884,8 @@ def finalize_success(table_id, skip_user_id=None):
 
 def handle_abandon(user_id):
     db = get_db()
-    row = db.execute("SELECT shop_id, amount, table_id FROM match_users WHERE user_id=?", (user_id,)).fetchone()
+    # 刪除放棄者（以刪掉那一刻的資料為準，不先讀再刪）
+    row = match_pool.leave(db, user_id)
     if not row:
         return None
 
@@ -402,87 +1893,556 @@ def handle_abandon(user_id):
     amount = row["amount"]
     table_id = row["table_id"]
 
-    # 刪除放棄者
-    db.execute("DELETE FROM match_users WHERE user_id=?", (user_id,))
-    db.commit()
-
     if table_id:
         # 有在確認桌：其餘玩家回到等待中，桌子作廢，繼續等待補人
-        db.execute("UPDATE match_users SET status='waiting', expire=NULL, table_id=NULL, table_index=NULL WHERE table_id=?", (table_id,))
         db.execute("DELETE FROM tables WHERE id=?", (table_id,))
-        db.commit()
+        back = match_pool.requeue(db, table_id)
+        after_commit(lambda: scheduler.cancel(table_id))
 
-        notify_table(table_id, "⚠ 有玩家放棄，已回到等待池，繼續配桌中…")
-        # 可能剛好補滿再成桌
-        try_make_table(shop_id, amount)
+        # 回池的玩家由 matcher 整批重新配桌（requeue 已標記）
+        notify_table(table_id, "⚠ 有玩家放棄，已回到等待池，繼續配桌中…", user_ids=back)
 
     return (shop_id, amount)
 
 
-def timeout_checker():
-    while True:
-        try:
-            with app.app_context():
-                db = get_db()
-                now = time.time()
-
-                # 先做提醒（20秒、10秒）
-                tables = db.execute("SELECT * FROM tables").fetchall()
-                for t in tables:
-                    table_id = t["id"]
-                    # 找該桌 expire（取任一 ready 的 expire）
-                    erow = db.execute("SELECT MIN(expire) AS ex FROM match_users WHERE table_id=? AND status='ready'", (table_id,)).fetchone()
-                    if not erow or not erow["ex"]:
-                        continue
-                    remain = int(erow["ex"] - now)
-
-                    if remain <= 20 and remain > 10 and t["r20"] == 0:
-                        db.execute("UPDATE tables SET r20=1 WHERE id=?", (table_id,))
-                        db.commit()
-                        notify_table(table_id, "⏳ 剩餘 20 秒未確認視同放棄")
-                    if remain <= 10 and remain > 0 and t["r10"] == 0:
-                        db.execute("UPDATE tables SET r10=1 WHERE id=?", (table_id,))
-                        db.commit()
-                        notify_table(table_id, "⏳ 剩餘 10 秒未確認視同放棄")
-
-                # 到期處理：ready 到期 -> 視同放棄（只退未確認者）
-                expired = db.execute("""
-                    SELECT user_id, table_id FROM match_users
-                    WHERE status='ready' AND expire IS NOT NULL AND expire < ?
-                """, (now,)).fetchall()
-
-                # 用 table_id 分組處理，避免重複
-                handled_tables = set()
-                for r in expired:
-                    table_id = r["table_id"]
-                    if not table_id or table_id in handled_tables:
-                        continue
-                    handled_tables.add(table_id)
-
-                    # 未確認者全部放棄
-                    unconfirmed = db.execute("SELECT user_id FROM match_users WHERE table_id=? AND status='ready'", (table_id,)).fetchall()
-                    for u in unconfirmed:
-                        db.execute("DELETE FROM match_users WHERE user_id=?", (u["user_id"],))
-
-                    # 其餘玩家回等待池
-                    db.execute("UPDATE match_users SET status='waiting', expire=NULL, table_id=NULL, table_index=NULL WHERE table_id=?", (table_id,))
-                    db.execute("DELETE FROM tables WHERE id=?", (table_id,))
-                    db.commit()
-
-                    notify_table(table_id, "⛔ 超過 30 秒未確認，視同放棄，已取消本次成桌並回到等待池")
-                    # 嘗試再成桌
-                    # 取 shop/amount 用任一 match_users waiting
-                    w = db.execute("SELECT shop_id, amount FROM match_users WHERE status='waiting' LIMIT 1").fetchone()
-                    if w:
-                        try_make_table(w["shop_id"], w["amount"])
+def cancel_match(db, user_id):
+    # 取消配桌：等待中直接退出（CAS，避免剛好被配進桌子時把人從桌上拔掉）；
+    # 成桌確認中等同放棄：自己退出，其他人回等待池繼續配桌
+    if match_pool.leave(db, user_id, status="waiting"):
+        return "cancel"
+    if handle_abandon(user_id):
+        return "abandon"
+    return None
+
+
+# ===== 到期排程（取代每 2 秒輪詢）=====
+# 以 heap 依時間排序，執行緒只睡到下一個到期時間；同一桌的排程以 table_id 分組，可整組取消。
+
+class DeadlineScheduler:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []    # [when, seq, fn, args, group, alive]
+        self.groups = {}  # group -> [entry, ...]
+        self.seq = 0
+
+    def schedule(self, when, group, fn, *args):
+        with self.cond:
+            self.seq += 1
+            entry = [when, self.seq, fn, args, group, True]
+            heapq.heappush(self.heap, entry)
+            self.groups.setdefault(group, []).append(entry)
+            if self.heap[0] is entry:
+                self.cond.notify()
+            return entry
+
+    def cancel(self, group):
+        with self.cond:
+            for entry in self.groups.pop(group, []):
+                entry[5] = False
+
+    def cancel_if(self, pred):
+        with self.cond:
+            for group in [g for g in self.groups if pred(g)]:
+                for entry in self.groups.pop(group):
+                    entry[5] = False
+
+    def has(self, group):
+        with self.cond:
+            return group in self.groups
+
+    def count(self, pred):
+        with self.cond:
+            return sum(1 for g in self.groups if pred(g))
+
+    def _next(self):
+        with self.cond:
+            while True:
+                while self.heap and not self.heap[0][5]:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                entry = heapq.heappop(self.heap)
+                entries = self.groups.get(entry[4])
+                if entries is not None:
+                    entries.remove(entry)
+                    if not entries:
+                        del self.groups[entry[4]]
+                return entry
+
+    def run(self):
+        while True:
+            entry = self._next()
+            t0 = time.time()
+            metrics.observe("mahjong_scheduler_lag_seconds", max(0.0, t0 - entry[0]))
+            sql_tracer.begin("scheduler")
+            try:
+                with unit_of_work():
+                    entry[2](*entry[3])
+            except Exception as e:
+                print("scheduler error:", e)
+            finally:
+                release_db()
+                sql_tracer.end(entry[2].__name__)
+                metrics.observe("mahjong_scheduler_task_seconds", time.time() - t0, task=entry[2].__name__)
 
-        except Exception as e:
-            print("timeout_checker error:", e)
 
-        time.sleep(2)
+scheduler = DeadlineScheduler()
 
 
-threading.Thread(target=timeout_checker, daemon=True).start()
+def schedule_table(table_id, expire):
+    # 每桌三個時間點：剩 20 秒提醒、剩 10 秒提醒、到期
+    # 多 worker 時只有 leader 排；其他 worker 開的桌由 leader 的 sync 從 DB 撿起來
+    if not leader.active:
+        return
+    scheduler.schedule(expire - 20, table_id, table_remind, table_id, 20, expire)
+    scheduler.schedule(expire - 10, table_id, table_remind, table_id, 10, expire)
+    scheduler.schedule(expire, table_id, table_expire, table_id)
+
+
+def load_table_deadlines(db):
+    rows = db.execute("""
+        SELECT t.id, MIN(m.expire) AS ex
+        FROM tables t JOIN match_users m ON m.table_id = t.id
+        WHERE m.status='ready' AND m.expire IS NOT NULL
+        GROUP BY t.id
+    """).fetchall()
+    for r in rows:
+        if not scheduler.has(r["id"]):
+            schedule_table(r["id"], r["ex"])
+
+
+def table_remind(table_id, sec, expire):
+    col = "r20" if sec == 20 else "r10"
+    db = get_db()
+    t = db.execute(f"SELECT {col} AS sent FROM tables WHERE id=?", (table_id,)).fetchone()
+    if not t or t["sent"]:
+        return
+    # 跟原本一樣只在提醒區間內送（重啟後補排的過期提醒直接略過）
+    remain = int(expire - time.time())
+    if not (sec - 10 < remain <= sec):
+        return
+    # 條件式更新：換 leader 的空窗若兩邊都排到，也只會有一邊送出
+    if db.execute(f"UPDATE tables SET {col}=1 WHERE id=? AND {col}=0", (table_id,)).rowcount != 1:
+        return
+    commit(db)
+    notify_table(table_id, f"⏳ 剩餘 {sec} 秒未確認視同放棄")
+
+
+def table_seats(db, table_id):
+    # (已確認的人數, 還沒確認的組數)；人數看 people，不是看幾組
+    row = db.execute("""
+        SELECT COALESCE(SUM(CASE WHEN status='confirmed' THEN people END), 0) AS seats,
+               COALESCE(SUM(status='ready'), 0) AS pending
+        FROM match_users WHERE table_id=?
+    """, (table_id,)).fetchone()
+    return int(row["seats"]), int(row["pending"])
+
+
+def table_expire(table_id):
+    # 到期處理：ready 到期 -> 視同放棄（只退未確認者）
+    db = get_db()
+    seats, pending = table_seats(db, table_id)
+    if not pending:
+        # 沒有人還在等確認：不是到期，是全員都確認了（加入那邊沒收尾就在這裡收）
+        if seats >= 4:
+            finalize_success(table_id)
+        return
+    # 先刪桌子當作認領：已經被放棄 / 成功 / 另一個 leader 處理掉的話這裡就刪不到
+    t = db.execute("DELETE FROM tables WHERE id=? RETURNING shop_id, amount", (table_id,)).fetchone()
+    if not t:
+        return
+    users = get_table_users(db, table_id)
+
+    # 未確認者全部放棄
+    db.execute("DELETE FROM match_users WHERE table_id=? AND status='ready'", (table_id,))
+
+    # 其餘玩家回等待池
+    match_pool.requeue(db, table_id)
+
+    # 回池的玩家由 matcher 整批重新配桌（requeue 已標記）
+    notify_table(table_id, "⛔ 超過 30 秒未確認，視同放棄，已取消本次成桌並回到等待池", user_ids=users)
+
+
+# ===== 排程 leader（MULTI_WORKER）=====
+# 每個 worker 都跑 scheduler（通知合併也用它），但桌子的提醒/到期只由持有 "scheduler" lease 的 worker 排。
+# leader 定期續約；續約失敗就把手上的桌子排程全部取消，讓新 leader 接手。
+# 新 leader 上任時由 DB 補排所有進行中的桌子，之後只在 data_version 變動（別的連線有 commit）時再同步。
+
+class SchedulerLeader:
+    def __init__(self, enabled, ttl, sync_every):
+        self.enabled = enabled
+        self.active = not enabled  # 單一 worker：永遠是 leader
+        self.lease = Lease("scheduler", ttl)
+        self.sync_every = sync_every
+
+    def _promote(self, db):
+        self.active = True
+        print(f"scheduler leader: {self.lease.owner}")
+        load_table_deadlines(db)
+
+    def _demote(self):
+        self.active = False
+        print(f"scheduler leader lost: {self.lease.owner}")
+        # 桌子的排程以 table_id（字串）分組；通知合併的 ("notify", table_id) 不動
+        scheduler.cancel_if(lambda group: isinstance(group, str))
+
+    def run(self):
+        db = get_db()
+        renewed = 0
+        data_version = None
+        while True:
+            now = time.time()
+            if now - renewed >= self.lease.ttl / 3:
+                try:
+                    held = self.lease.renew(db)
+                    renewed = now
+                except sqlite3.Error as e:
+                    print("lease renew error:", e)
+                    db.rollback()
+                    held = now - renewed < self.lease.ttl * 2 / 3
+                if held and not self.active:
+                    self._promote(db)
+                    data_version = db.execute("PRAGMA data_version").fetchone()[0]
+                elif not held and self.active:
+                    self._demote()
+            if self.active:
+                v = db.execute("PRAGMA data_version").fetchone()[0]
+                if v != data_version:
+                    data_version = v
+                    try:
+                        load_table_deadlines(db)
+                    except sqlite3.Error as e:
+                        print("scheduler sync error:", e)
+            time.sleep(self.sync_every)
+
+    def release(self):
+        if self.enabled and self.active:
+            try:
+                self.lease.release(get_db())
+            except sqlite3.Error:
+                pass
+
+
+leader = SchedulerLeader(MULTI_WORKER, LEASE_TTL, SCHEDULER_SYNC_SEC)
+
+
+def sweep_sessions():
+    # 多 worker 時只由 leader 清 DB，避免每個 worker 都搶寫入鎖做同一件事
+    if leader.active:
+        n = sessions.sweep(get_db())
+        if n:
+            print(f"session sweep: {n} expired")
+    # group 用 tuple：換 leader 時只取消字串 group（桌子），這個不受影響
+    scheduler.schedule(time.time() + SESSION_SWEEP_SEC, ("sweep", "sessions"), sweep_sessions)
+
+
+# ===== 資料保存 / 封存 / 整理（背景維護）=====
+# 只由 scheduler leader 做，而且要等安靜（所有 worker MAINT_QUIET_SEC 內都沒有事件，多 worker 時看 activity 表）才動手；
+# 做到一半有事件進來就先停。
+#   1. 記事本：NOTES_KEEP_MONTHS 個月以前的紀錄搬到 archive/notes-YYYY-MM.jsonl.gz（note_months 月合計留著）
+#   2. 配桌紀錄：match_history 超過 HISTORY_KEEP_DAYS 天的搬到 archive/matches-YYYY-MM.jsonl.gz
+#   3. 過期 session_state（平常 sweep_sessions 也會清）
+#   4. incremental_vacuum 把空頁還給檔案系統，wal_checkpoint(TRUNCATE) 把 -wal 縮回 0
+#      （舊的 auto_vacuum=NONE 檔要 MAINT_FULL_VACUUM=1 才會整檔轉換）
+# 封存是先寫檔、fsync，再刪，每批一個交易；中途掛掉頂多在封存檔裡留重複的列（有 id 可去重）。
+
+class Maintenance:
+    def __init__(self, interval, quiet, archive_dir, batch):
+        self.interval = interval
+        self.quiet = quiet
+        self.archive_dir = archive_dir
+        self.batch = batch
+        self.last_activity = 0.0
+        self.published = 0.0
+        self.publish_every = max(1.0, quiet / 4)
+        self.last_run = 0.0
+        self.last = None  # 上一次的報告
+
+    def touch(self):
+        # 在事件的交易裡呼叫；多 worker 時每 publish_every 秒把時間寫進 activity 一次（跟事件一起 commit）
+        now = time.time()
+        self.last_activity = now
+        if MULTI_WORKER and now - self.published >= self.publish_every:
+            self.published = now
+            get_db().execute(
+                "INSERT INTO activity(name, at) VALUES('event', ?) ON CONFLICT(name) DO UPDATE SET at=MAX(at, excluded.at)",
+                (now,)
+            )
+
+    def is_quiet(self):
+        last = self.last_activity
+        if MULTI_WORKER:
+            row = get_db().execute("SELECT at FROM activity WHERE name='event'").fetchone()
+            if row:
+                last = max(last, row["at"])
+        # 別的 worker 最多晚 publish_every 秒才寫進來，所以要多等這麼久
+        return time.time() - last >= self.quiet + (self.publish_every if MULTI_WORKER else 0) and event_queue.depth() == 0
+
+    def run(self):
+        while True:
+            time.sleep(max(1, min(self.quiet, self.interval) / 2))
+            if not leader.active or time.time() - self.last_run < self.interval or not self.is_quiet():
+                continue
+            self.last_run = time.time()
+            try:
+                self.last = self.run_once()
+                print("maintenance:", json.dumps(self.last))
+            except Exception as e:
+                print("maintenance error:", e)
+            finally:
+                release_db()
+
+    def run_once(self):
+        t0 = time.time()
+        db = get_db()
+        before = self.file_sizes()
+        report = {
+            "notes_archived": self.archive_notes(db),
+            "matches_archived": self.archive_matches(db),
+            "sessions_purged": sessions.sweep(db),
+        }
+        report.update(self.vacuum(db))
+        busy, _log, _done = db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        after = self.file_sizes()
+        reclaimed = max(0, sum(before) - sum(after))
+        metrics.inc("mahjong_vacuum_reclaimed_bytes_total", reclaimed)
+        report.update(
+            checkpoint_busy=bool(busy),
+            db_bytes_before=before[0], wal_bytes_before=before[1],
+            db_bytes=after[0], wal_bytes=after[1],
+            reclaimed_bytes=reclaimed,
+            seconds=round(time.time() - t0, 3), at=int(t0),
+        )
+        return report
+
+    def file_sizes(self):
+        sizes = []
+        for path in (DB_PATH, DB_PATH + "-wal"):
+            try:
+                sizes.append(os.path.getsize(path))
+            except OSError:
+                sizes.append(0)
+        return sizes
+
+    def archive_notes(self, db):
+        now = datetime.now()
+        y, m = now.year, now.month - (NOTES_KEEP_MONTHS - 1)
+        while m <= 0:
+            y, m = y - 1, m + 12
+        cutoff = y * 10000 + m * 100 + 1
+        return self._archive(
+            db, "notes",
+            "SELECT id, user_id, content, amount, time, day FROM notes WHERE day < ? ORDER BY id LIMIT ?", (cutoff,),
+            lambda r: f"{r['day'] // 10000:04d}-{r['day'] // 100 % 100:02d}",
+            "DELETE FROM notes WHERE id=?", "id",
+        )
+
+    def archive_matches(self, db):
+        return self._archive(
+            db, "matches",
+            "SELECT * FROM match_history WHERE finished < ? ORDER BY finished LIMIT ?", (time.time() - HISTORY_KEEP_DAYS * 86400,),
+            lambda r: datetime.fromtimestamp(r["finished"]).strftime("%Y-%m"),
+            "DELETE FROM match_history WHERE table_id=?", "table_id",
+        )
+
+    def _archive(self, db, kind, select_sql, params, month_of, delete_sql, key):
+        total = 0
+        while self.is_quiet():
+            rows = db.execute(select_sql, params + (self.batch,)).fetchall()
+            if not rows:
+                break
+            by_month = {}
+            for r in rows:
+                by_month.setdefault(month_of(r), []).append(dict(r))
+            for month, items in by_month.items():
+                self._append(f"{kind}-{month}.jsonl.gz", items)
+            with unit_of_work() as db:
+                db.executemany(delete_sql, [(r[key],) for r in rows])
+            total += len(rows)
+            metrics.inc("mahjong_archived_rows_total", len(rows), kind=kind)
+        return total
+
+    def _append(self, name, items):
+        # 每次附加一個 gzip member；gzip.open 讀的時候會自動接起來
+        os.makedirs(self.archive_dir, exist_ok=True)
+        data = "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items).encode()
+        with open(os.path.join(self.archive_dir, name), "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as gz:
+                gz.write(data)
+            raw.flush()
+            os.fsync(raw.fileno())
+
+    def vacuum(self, db):
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        free = db.execute("PRAGMA freelist_count").fetchone()[0]
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # 舊檔是 auto_vacuum=NONE：要整檔 VACUUM 一次才會切過去，之後都只做 incremental。
+            # 整檔 VACUUM 期間所有寫入都要等（別的 worker 會等到 busy timeout 回 500），所以要明確開啟才做
+            if not MAINT_FULL_VACUUM:
+                return {"vacuum": "skipped (auto_vacuum=NONE; set MAINT_FULL_VACUUM=1 during downtime to convert)",
+                        "freed_pages": 0, "page_size": page_size}
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            db.execute("VACUUM")
+            return {"vacuum": "full", "freed_pages": free, "page_size": page_size}
+        freed = 0
+        while free > 0 and self.is_quiet():
+            # incremental_vacuum 要一路 step 到底才會真的釋放；executescript 會跑完
+            db.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+            left = db.execute("PRAGMA freelist_count").fetchone()[0]
+            if left >= free:
+                break
+            freed += free - left
+            free = left
+        return {"vacuum": "incremental", "freed_pages": freed, "page_size": page_size}
+
+
+maintenance = Maintenance(MAINT_INTERVAL_SEC, MAINT_QUIET_SEC, ARCHIVE_DIR, MAINT_BATCH)
+
+
+init_db()
+match_pool.load(get_db())
+if not MULTI_WORKER:
+    load_table_deadlines(get_db())
+
+# ===== 事件佇列（CALLBACK_ASYNC）=====
+# 依 user_id 分派到固定的 worker：同一使用者的事件嚴格照順序，不同使用者並行處理。
+
+def event_user_key(event):
+    src = event.source
+    return getattr(src, "user_id", None) or getattr(src, "group_id", None) or getattr(src, "room_id", None) or ""
+
+
+def dispatch_event(event, destination=None):
+    # 跟 WebhookHandler.handle 一樣的對應規則（先找 事件_訊息，再找 事件，最後 default）
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__)
+    if func is None:
+        func = handler._default
+    if func is not None:
+        func(event)
+
+
+class EventQueue:
+    def __init__(self, workers):
+        self.queues = [queue.Queue() for _ in range(max(1, workers))]
+        self.lock = threading.Lock()
+        self.started = False
+        self.processed = 0
+        self.errors = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        for q in self.queues:
+            threading.Thread(target=self._worker, args=(q,), daemon=True).start()
+
+    def put(self, event, destination=None):
+        q = self.queues[hash(event_user_key(event)) % len(self.queues)]
+        q.put((time.time(), event, destination))
+
+    def join(self):
+        for q in self.queues:
+            q.join()
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": self.depth(),
+                "processed": self.processed,
+                "errors": self.errors,
+                "lag_last": round(self.lag_last, 4),
+                "lag_max": round(self.lag_max, 4),
+            }
+
+    def _worker(self, q):
+        while True:
+            queued_at, event, destination = q.get()
+            lag = time.time() - queued_at
+            ok = True
+            try:
+                with app.app_context():
+                    dispatch_event(event, destination)
+            except Exception as e:
+                ok = False
+                print("event worker error:", e)
+            finally:
+                with self.lock:
+                    self.processed += 1
+                    self.errors += 0 if ok else 1
+                    self.lag_last = lag
+                    self.lag_max = max(self.lag_max, lag)
+                q.task_done()
+
+
+event_queue = EventQueue(EVENT_WORKERS)
+
+
+# ===== 同一次 webhook 多個事件（同步模式）=====
+# LINE 可能把多個使用者的事件放在同一個 body；WebhookHandler.handle 會一個接一個跑，
+# 某個使用者卡在 LINE API 時整批都在等。改成依使用者分組：組內照順序，不同組在 delivery_pool 並行，
+# 第一組直接在 request 執行緒跑；全部做完才回 200（跟原本一樣，例外照樣讓 webhook 回 500）。
+
+delivery_pool = ThreadPoolExecutor(max_workers=max(1, DELIVERY_WORKERS), thread_name_prefix="delivery")
+
+
+def run_event_group(events, destination):
+    with app.app_context():
+        for event in events:
+            dispatch_event(event, destination)
+
+
+def dispatch_delivery(events, destination=None):
+    t0 = time.perf_counter()
+    groups = {}
+    for event in events:
+        groups.setdefault(event_user_key(event), []).append(event)
+    mode = "parallel" if len(groups) > 1 and DELIVERY_WORKERS > 1 else "serial"
+    try:
+        if mode == "serial":
+            for event in events:
+                dispatch_event(event, destination)
+            return
+        first, *rest = groups.values()
+        futures = [delivery_pool.submit(run_event_group, g, destination) for g in rest]
+        error = None
+        try:
+            for event in first:
+                dispatch_event(event, destination)
+        except Exception as e:
+            error = e
+        for f in futures:
+            e = f.exception()
+            if error is None and e is not None:
+                error = e
+        if error is not None:
+            raise error
+    finally:
+        metrics.inc("mahjong_delivery_events_total", len(events), mode=mode)
+        metrics.observe("mahjong_delivery_seconds", time.perf_counter() - t0, mode=mode)
+
+threading.Thread(target=scheduler.run, daemon=True).start()
+scheduler.schedule(time.time() + SESSION_SWEEP_SEC, ("sweep", "sessions"), sweep_sessions)
+dispatcher.start()
+if CALLBACK_ASYNC:
+    event_queue.start()
+threading.Thread(target=maintenance.run, daemon=True).start()
+if MULTI_WORKER:
+    threading.Thread(target=leader.run, daemon=True).start()
+    atexit.register(leader.release)  # 正常關閉（重新部署）時立刻讓出 lease，不用等 ttl
 
 
 @app.route("/callback", methods=["POST"])
@@ -490,554 +2450,818 @@ def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        payload = handler.parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
         abort(400)
+    if CALLBACK_ASYNC:
+        for event in payload.events:
+            event_queue.put(event, payload.destination)
+        return "OK"
+    dispatch_delivery(payload.events, payload.destination)
     return "OK"
 
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    # 事件佇列深度 / 處理延遲（lag = 收到 webhook 到開始處理的秒數）
+    return {
+        "async": CALLBACK_ASYNC,
+        "event_queue": event_queue.stats(),
+        "worker": {"pid": os.getpid(), "multi": MULTI_WORKER, "scheduler_leader": leader.active},
+        "sql_trace": sql_tracer.summary() if sql_tracer.enabled else None,
+        "maintenance": maintenance.last,
+    }
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def pool_sizes():
+    # {(shop_id, amount): (組數, 人數)}；只讀記憶體配桌池
+    with match_pool.lock:
+        return {
+            key: (sum(len(b) for b in buckets.values()), sum(p * len(b) for p, b in buckets.items()))
+            for key, buckets in match_pool.pools.items()
+        }
+
+
+metrics.gauge("mahjong_waiting_parties", "Parties waiting in each pool",
+              lambda: {(("amount", k[1]), ("shop_id", k[0])): v[0] for k, v in pool_sizes().items()})
+metrics.gauge("mahjong_waiting_players", "Players waiting in each pool",
+              lambda: {(("amount", k[1]), ("shop_id", k[0])): v[1] for k, v in pool_sizes().items()})
+# 桌子的到期排程以 table_id（字串）分組；多 worker 時只有 leader 有排程，其他 worker 回 0
+metrics.gauge("mahjong_tables_pending_confirmation", "Tables waiting for players to confirm (scheduler leader only)",
+              lambda: scheduler.count(lambda group: isinstance(group, str)))
+metrics.gauge("mahjong_match_dirty_pools", "Pools waiting for the matcher", matcher.pending)
+metrics.gauge("mahjong_db_file_bytes", "data.db size on disk (main file + WAL)", lambda: sum(maintenance.file_sizes()))
+metrics.gauge("mahjong_scheduler_leader", "1 if this worker runs table deadlines", lambda: int(leader.active))
+metrics.gauge("mahjong_scheduler_groups", "Scheduled deadline groups (tables, notify flushes, sweeps)",
+              lambda: scheduler.count(lambda group: True))
+metrics.gauge("mahjong_push_queue_depth", "Messages waiting for the push workers",
+              lambda: sum(q.qsize() for q in dispatcher.queues))
+metrics.gauge("mahjong_event_queue_depth", "Webhook events waiting (CALLBACK_ASYNC)", event_queue.depth)
+metrics.gauge("mahjong_event_queue_lag_seconds", "Queue wait of the last processed event (CALLBACK_ASYNC)",
+              lambda: round(event_queue.lag_last, 4))
+
+
 @handler.add(PostbackEvent)
+@transactional
 def handle_postback(event):
-    init_db()
     db = get_db()
 
     user_id = event.source.user_id
     data = (event.postback.data or "").strip()
+    set_command("postback:" + data.split("=", 1)[0])
 
     # 選店家：使用 Postback，避免聊天室顯示「店家:shop_id」
     if data.startswith("shop="):
         sid = data.split("=", 1)[1].strip()
-        user_state[user_id] = {"mode": "wait_amount", "shop_id": sid}
-        ss_set(db, user_id, shop_id=sid, amount=None)
-        items = [
-            QuickReplyButton(action=MessageAction(label="50/20", text="金額:50/20")),
-            QuickReplyButton(action=MessageAction(label="100/20", text="金額:100/20")),
-            QuickReplyButton(action=MessageAction(label="100/50", text="金額:100/50")),
-            QuickReplyButton(action=MessageAction(label="200/50", text="金額:200/50")),
-            QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-        ]
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("請選擇金額", quick_reply=QuickReply(items=items)))
-        return
-
-
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    init_db()
-    db = get_db()
-
-    user_id = event.source.user_id
-    text = (event.message.text or "").strip()
-
-    # ===== 查自己的 LINE User ID =====
-    if text in ("賴ID", "賴id", "LINEID", "lineid"):
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(f"你的 LINE User ID：{user_id}", quick_reply=back_menu())
-        )
-        return
-
-    # ===== 回主選單 =====
-    if text == "選單":
-        user_state.pop(user_id, None)
-        ss_clear(db, user_id)
-        line_bot_api.reply_message(event.reply_token, main_menu(user_id))
+        sessions.put(db, user_id, {"mode": "wait_amount", "shop_id": sid})
+        reply(event.reply_token, AMOUNT_PICKER)
         return
 
-    # ===== 管理入口 =====
-    if user_id in ADMIN_IDS and text == "店家管理":
-        user_state[user_id] = {"mode": "admin_menu"}
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(
-            "🛠 店家管理",
-            quick_reply=QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="📋 查看店家", text="管理:查看")),
-                QuickReplyButton(action=MessageAction(label="✅ 審核店家", text="管理:審核")),
-                QuickReplyButton(action=MessageAction(label="🗑 刪除店家", text="管理:刪除")),
-                QuickReplyButton(action=MessageAction(label="🗺 地圖設定", text="管理:地圖設定")),
-                QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-            ])
-        ))
+    # 店家選單下一頁：shops=<kind>:<rowid>:<店名開頭>
+    # 游標格式不對（舊版按鈕、被竄改）或沒有權限：一律回主選單
+    if data.startswith("shops="):
+        cursor = parse_shop_cursor(data.split("=", 1)[1])
+        if cursor is None or not shop_picker_allowed(user_id, cursor[0]):
+            reply(event.reply_token, main_menu(user_id))
+            return
+        kind, after, prefix = cursor
+        reply(event.reply_token, shop_picker_msg(db, kind, after=after, prefix=prefix))
         return
 
-    # 管理：查看
-    if user_id in ADMIN_IDS and text == "管理:查看":
-        rows = db.execute("SELECT shop_id, name, open, approved FROM shops ORDER BY rowid DESC").fetchall()
-        if not rows:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("目前沒有店家", quick_reply=back_menu()))
+    # 店家選單搜尋：下一則文字當店名開頭
+    if data.startswith("shopsearch="):
+        kind = data.split("=", 1)[1]
+        if not shop_picker_allowed(user_id, kind):
+            reply(event.reply_token, main_menu(user_id))
             return
-        msg = "🏪 店家列表\n\n"
-        for r in rows:
-            msg += f"{r['name']}\n狀態：{'營業中' if r['open'] else '未營業'} | {'✅通過' if r['approved'] else '❌未審核'}\nID:{r['shop_id']}\n\n"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(msg.strip(), quick_reply=back_menu()))
+        sessions.put(db, user_id, {"mode": "shop_search", "kind": kind})
+        reply(event.reply_token, text_msg("請輸入店名開頭（例如：大三元）", quick_reply=QR_BACK))
         return
 
-    # 管理：審核
-    if user_id in ADMIN_IDS and text == "管理:審核":
-        rows = db.execute("SELECT shop_id, name, approved FROM shops ORDER BY rowid DESC").fetchall()
-        if not rows:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("目前沒有店家", quick_reply=back_menu()))
+    # 記事本月報表下一頁：notes=<view>:<month>:<day>:<id>
+    if data.startswith("notes="):
+        parts = data.split("=", 1)[1].split(":")
+        if len(parts) != 4 or parts[0] not in NOTE_VIEWS or not all(p.isdigit() for p in parts[1:]):
+            reply(event.reply_token, main_menu(user_id))
             return
-        items = []
-        for r in rows:
-            items.append(QuickReplyButton(action=MessageAction(label=(r["name"] or "")[:20], text=f"管理:審核:{r['shop_id']}")))
-        items.append(QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")))
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("選擇要審核的店家", quick_reply=QuickReply(items=items)))
+        view, month, day, nid = parts
+        reply(event.reply_token, note_month_msg(db, user_id, view, int(month), after=(int(day), int(nid))))
         return
 
-    if user_id in ADMIN_IDS and text.startswith("管理:審核:"):
-        sid = text.split(":", 2)[2]
-        user_state[user_id] = {"mode": "admin_review", "sid": sid}
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(
-            "請選擇審核結果",
-            quick_reply=QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="✅ 通過", text="管理:同意")),
-                QuickReplyButton(action=MessageAction(label="❌ 不通過", text="管理:不同意")),
-                QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-            ])
-        ))
-        return
 
-    if user_id in ADMIN_IDS and user_state.get(user_id, {}).get("mode") == "admin_review":
-        sid = user_state[user_id]["sid"]
-        if text == "管理:同意":
-            db.execute("UPDATE shops SET approved=1 WHERE shop_id=?", (sid,))
-            db.commit()
-            user_state.pop(user_id, None)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("✅ 已通過", quick_reply=back_menu()))
-            return
-        if text == "管理:不同意":
-            db.execute("UPDATE shops SET approved=0 WHERE shop_id=?", (sid,))
-            db.commit()
-            user_state.pop(user_id, None)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("❌ 已設為不通過", quick_reply=back_menu()))
-            return
+# ===== 文字指令路由 =====
+# 取代原本 handle_message 一路 if 比下去：
+#   完全相同的指令 -> dict 查表；前綴指令（金額: / 人數: / 地圖: / 管理:審核: ...）-> 依前綴長度查表；
+#   流程中的輸入狀態（暱稱 / 記事金額 / 店家申請 / 群組 / 地圖連結）-> 依 mode 查表。
+# 每個指令照註冊順序有一個優先序，多個都符合時取最前面的，跟原本 if-chain 的先後完全一致。
+
+class Route:
+    __slots__ = ("order", "fn", "admin", "mode")
+
+    def __init__(self, order, fn, admin, mode):
+        self.order = order
+        self.fn = fn
+        self.admin = admin
+        self.mode = mode
+
+    def allowed(self, is_admin, mode):
+        return (is_admin or not self.admin) and (self.mode is None or self.mode == mode)
+
+
+class CommandRouter:
+    def __init__(self):
+        self.exact = {}        # text -> Route
+        self.prefixes = {}     # prefix -> Route
+        self.prefix_lens = ()  # 由長到短
+        self.modes = {}        # mode -> Route
+        self.count = 0
+
+    def _route(self, fn, admin, mode=None):
+        self.count += 1
+        return Route(self.count, fn, admin, mode)
+
+    def command(self, *texts, admin=False, mode=None):
+        def decorator(fn):
+            route = self._route(fn, admin, mode)
+            for t in texts:
+                self.exact[t] = route
+            return fn
+        return decorator
+
+    def prefix(self, prefix, admin=False):
+        def decorator(fn):
+            self.prefixes[prefix] = self._route(fn, admin)
+            self.prefix_lens = tuple(sorted({len(p) for p in self.prefixes}, reverse=True))
+            return fn
+        return decorator
+
+    def state(self, mode, admin=False):
+        # 該 mode 下任何（沒被更前面指令攔走的）文字都交給 fn
+        def decorator(fn):
+            self.modes[mode] = self._route(fn, admin)
+            return fn
+        return decorator
+
+    def resolve(self, user_id, text, mode):
+        is_admin = user_id in ADMIN_IDS
+        best = self.exact.get(text)
+        if best is not None and not best.allowed(is_admin, mode):
+            best = None
+        for n in self.prefix_lens:
+            r = self.prefixes.get(text[:n])
+            if r is not None and r.allowed(is_admin, mode) and (best is None or r.order < best.order):
+                best = r
+        if mode:
+            r = self.modes.get(mode)
+            if r is not None and r.allowed(is_admin, mode) and (best is None or r.order < best.order):
+                best = r
+        return best
+
+
+router = CommandRouter()
+
+
+# ===== 查自己的 LINE User ID =====
+@router.command("賴ID", "賴id", "LINEID", "lineid")
+def on_line_id(event, db, user_id, text, st):
+    reply(
+        event.reply_token,
+        text_msg(f"你的 LINE User ID：{user_id}", quick_reply=QR_BACK)
+    )
 
-    # 管理：刪除
-    if user_id in ADMIN_IDS and text == "管理:刪除":
-        rows = db.execute("SELECT shop_id, name FROM shops ORDER BY rowid DESC").fetchall()
-        if not rows:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("目前沒有店家", quick_reply=back_menu()))
-            return
-        items = [QuickReplyButton(action=MessageAction(label=(r["name"] or "")[:20], text=f"管理:刪除:{r['shop_id']}")) for r in rows]
-        items.append(QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")))
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("選擇要刪除的店家", quick_reply=QuickReply(items=items)))
-        return
 
-    if user_id in ADMIN_IDS and text.startswith("管理:刪除:"):
-        sid = text.split(":", 2)[2]
-        db.execute("DELETE FROM shops WHERE shop_id=?", (sid,))
-        db.commit()
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("🗑 已刪除", quick_reply=back_menu()))
-        return
+# ===== 回主選單 =====
+@router.command("選單")
+def on_menu(event, db, user_id, text, st):
+    sessions.clear(db, user_id)
+    reply(event.reply_token, main_menu(user_id))
 
-    # 管理：地圖設定
-    if user_id in ADMIN_IDS and text == "管理:地圖設定":
-        rows = db.execute("SELECT shop_id, name FROM shops WHERE approved=1 ORDER BY rowid DESC").fetchall()
-        if not rows:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("目前沒有已核准店家", quick_reply=back_menu()))
-            return
-        items = [QuickReplyButton(action=MessageAction(label=(r["name"] or "")[:20], text=f"管理:地圖:{r['shop_id']}")) for r in rows]
-        items.append(QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")))
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("選擇要設定地圖的店家", quick_reply=QuickReply(items=items)))
-        return
 
-    if user_id in ADMIN_IDS and text.startswith("管理:地圖:"):
-        sid = text.split(":", 2)[2]
-        user_state[user_id] = {"mode": "admin_map_input", "sid": sid}
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("請貼上地圖連結（Google Maps 連結）", quick_reply=back_menu()))
-        return
+# ===== 管理入口 =====
+@router.command("店家管理", admin=True)
+def on_admin_menu(event, db, user_id, text, st):
+    sessions.put(db, user_id, {"mode": "admin_menu"})
+    reply(event.reply_token, ADMIN_MENU)
 
-    if user_id in ADMIN_IDS and user_state.get(user_id, {}).get("mode") == "admin_map_input":
-        sid = user_state[user_id]["sid"]
-        link = text.strip()
-        db.execute("UPDATE shops SET partner_map=? WHERE shop_id=?", (link, sid))
-        db.commit()
-        user_state.pop(user_id, None)
-        ss_clear(db, user_id)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("✅ 已更新地圖連結", quick_reply=back_menu()))
-        return
 
-    # ===== 設定暱稱 =====
-    if text == "設定暱稱":
-        user_state[user_id] = {"mode": "nickname_input"}
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("請輸入你的暱稱（最多 12 字）", quick_reply=back_menu()))
-        return
+# 管理：查看
+@router.command("管理:查看", admin=True)
+def on_admin_list(event, db, user_id, text, st):
+    reply(event.reply_token, shop_picker_msg(db, "list"))
 
-    if user_state.get(user_id, {}).get("mode") == "nickname_input":
-        nk = text.strip()[:12]
-        db.execute("INSERT OR REPLACE INTO nicknames(user_id, nickname) VALUES(?,?)", (user_id, nk))
-        db.commit()
-        user_state.pop(user_id, None)
-        ss_clear(db, user_id)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(f"✅ 暱稱已設定：{nk}", quick_reply=back_menu()))
-        return
 
-    # ===== 記事本（保留原本：新增 / 當月 / 上月 / 清除）=====
-    if text == "記事本":
-        user_state[user_id] = {"mode": "note_menu"}
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(
-            "📒 記事本",
-            quick_reply=QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="➕ 新增紀錄", text="新增紀錄")),
-                QuickReplyButton(action=MessageAction(label="📅 查看當月", text="查看當月")),
-                QuickReplyButton(action=MessageAction(label="⏪ 查看上月", text="查看上月")),
-                QuickReplyButton(action=MessageAction(label="🧹 清除紀錄", text="清除紀錄")),
-                QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-            ])
-        ))
-        return
+# 管理：審核
+@router.command("管理:審核", admin=True)
+def on_admin_review_list(event, db, user_id, text, st):
+    reply(event.reply_token, shop_picker_msg(db, "review"))
 
-    if text == "新增紀錄":
-        user_state[user_id] = {"mode": "note_amount"}
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("請輸入金額，例如：1000 或 -500", quick_reply=back_menu()))
-        return
 
-    if user_state.get(user_id, {}).get("mode") == "note_amount":
-        val = text.strip()
-        if not re.fullmatch(r"-?\d+", val):
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("請直接輸入金額，例如：1000 或 -500", quick_reply=back_menu()))
-            return
-        amount = int(val)
-        db.execute("INSERT INTO notes(user_id, content, amount, time) VALUES(?,?,?,?)", (user_id, "", amount, datetime.now().strftime("%Y-%m-%d")))
-        db.commit()
-        user_state.pop(user_id, None)
-        ss_clear(db, user_id)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(f"✅ 已新增：{amount:+}", quick_reply=back_menu()))
-        return
+@router.prefix("管理:審核:", admin=True)
+def on_admin_review_pick(event, db, user_id, text, st):
+    sid = text.split(":", 2)[2]
+    sessions.put(db, user_id, {"mode": "admin_review", "sid": sid})
+    reply(event.reply_token, ADMIN_REVIEW)
 
-    if text == "查看當月":
-        today = datetime.now()
-        month_start = today.strftime("%Y-%m-01")
-        rows = db.execute("SELECT amount, time FROM notes WHERE user_id=? AND time >= ? ORDER BY time DESC", (user_id, month_start)).fetchall()
-        if not rows:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("📅 本月尚無紀錄", quick_reply=back_menu()))
-            return
-        total = 0
-        msg = "📅 本月紀錄\n\n"
-        for r in rows:
-            total += int(r["amount"])
-            msg += f"{r['time']}｜{int(r['amount']):+}\n"
-        msg += f"\n💰 合計：{total:+}"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(msg, quick_reply=back_menu()))
+
+@router.command("管理:同意", "管理:不同意", admin=True, mode="admin_review")
+def on_admin_review_result(event, db, user_id, text, st):
+    sid = st["sid"]
+    if text == "管理:同意":
+        db.execute("UPDATE shops SET approved=1 WHERE shop_id=?", (sid,))
+        commit(db)
+        shops_changed()
+        sessions.clear(db, user_id)
+        reply(event.reply_token, text_msg("✅ 已通過", quick_reply=QR_BACK))
         return
+    db.execute("UPDATE shops SET approved=0 WHERE shop_id=?", (sid,))
+    commit(db)
+    shops_changed()
+    sessions.clear(db, user_id)
+    reply(event.reply_token, text_msg("❌ 已設為不通過", quick_reply=QR_BACK))
+
+
+# 管理：刪除
+@router.command("管理:刪除", admin=True)
+def on_admin_delete_list(event, db, user_id, text, st):
+    reply(event.reply_token, shop_picker_msg(db, "delete"))
+
+
+@router.prefix("管理:刪除:", admin=True)
+def on_admin_delete(event, db, user_id, text, st):
+    sid = text.split(":", 2)[2]
+    db.execute("DELETE FROM shops WHERE shop_id=?", (sid,))
+    commit(db)
+    shops_changed()
+    reply(event.reply_token, text_msg("🗑 已刪除", quick_reply=QR_BACK))
+
+
+# 管理：地圖設定
+@router.command("管理:地圖設定", admin=True)
+def on_admin_map_list(event, db, user_id, text, st):
+    reply(event.reply_token, shop_picker_msg(db, "mapset"))
+
+
+@router.prefix("管理:地圖:", admin=True)
+def on_admin_map_pick(event, db, user_id, text, st):
+    sid = text.split(":", 2)[2]
+    sessions.put(db, user_id, {"mode": "admin_map_input", "sid": sid, "until": time.time() + LOCATION_INPUT_SEC})
+    reply(event.reply_token, text_msg("請貼上地圖連結（Google Maps 連結），或傳送店家位置", quick_reply=QR_SEND_LOCATION))
+
+
+@router.state("admin_map_input", admin=True)
+def on_admin_map_input(event, db, user_id, text, st):
+    sid = st["sid"]
+    link = text.strip()
+    db.execute("UPDATE shops SET partner_map=? WHERE shop_id=?", (link, sid))
+    commit(db)
+    shops_changed()
+    sessions.clear(db, user_id)
+    reply(event.reply_token, text_msg("✅ 已更新地圖連結", quick_reply=QR_BACK))
+
+
+# ===== 設定暱稱 =====
+@router.command("設定暱稱")
+def on_nickname(event, db, user_id, text, st):
+    sessions.put(db, user_id, {"mode": "nickname_input"})
+    reply(event.reply_token, text_msg("請輸入你的暱稱（最多 12 字）", quick_reply=QR_BACK))
+
+
+@router.state("nickname_input")
+def on_nickname_input(event, db, user_id, text, st):
+    nk = text.strip()[:12]
+    db.execute("INSERT OR REPLACE INTO nicknames(user_id, nickname) VALUES(?,?)", (user_id, nk))
+    commit(db)
+    versions.bump(db, "nicknames")
+    after_commit(lambda: nickname_cache.invalidate(user_id))
+    sessions.clear(db, user_id)
+    reply(event.reply_token, text_msg(f"✅ 暱稱已設定：{nk}", quick_reply=QR_BACK))
+
+
+# ===== 記事本（保留原本：新增 / 當月 / 上月 / 清除）=====
+# notes.day 存 YYYYMMDD 整數（可排序、走 (user_id, day) 索引）；
+# note_months 是每人每月的合計/筆數，新增紀錄時在同一個交易內累加，月報表的合計只查一列。
+# 明細依 (day, id) 由新到舊分頁，下一頁的游標放在 postback（notes=view:month:day:id）。
+
+NOTE_VIEWS = {
+    "this": ("📅 本月紀錄", "📅 本月尚無紀錄"),
+    "last": ("⏪ 上月紀錄", "⏪ 上月尚無紀錄"),
+}
+
+
+def note_add(db, user_id, amount, when):
+    day = int(when.strftime("%Y%m%d"))
+    db.execute(
+        "INSERT INTO notes(user_id, content, amount, time, day) VALUES(?,?,?,?,?)",
+        (user_id, "", amount, when.strftime("%Y-%m-%d"), day)
+    )
+    db.execute("""
+        INSERT INTO note_months(user_id, month, total, count) VALUES(?,?,?,1)
+        ON CONFLICT(user_id, month) DO UPDATE SET total=total+excluded.total, count=count+1
+    """, (user_id, day // 100, amount))
+
+
+def note_clear(db, user_id):
+    db.execute("DELETE FROM notes WHERE user_id=?", (user_id,))
+    db.execute("DELETE FROM note_months WHERE user_id=?", (user_id,))
+
+
+def note_month_msg(db, user_id, view, month, after=None):
+    title, empty = NOTE_VIEWS[view]
+    summary = db.execute("SELECT total, count FROM note_months WHERE user_id=? AND month=?", (user_id, month)).fetchone()
+    if not summary or not summary["count"]:
+        return text_msg(empty, quick_reply=QR_BACK)
 
-    if text == "查看上月":
-        today = datetime.now()
-        first = today.replace(day=1)
-        last_month_end = first - timedelta(days=1)
-        last_month_start = last_month_end.replace(day=1)
+    # after = 上一頁最後一筆的 (day, id)
+    last_day, last_id = after or (month * 100 + 99, -1)
+    if after:
         rows = db.execute(
-            "SELECT amount, time FROM notes WHERE user_id=? AND time BETWEEN ? AND ? ORDER BY time DESC",
-            (user_id, last_month_start.strftime("%Y-%m-%d"), last_month_end.strftime("%Y-%m-%d"))
+            "SELECT id, day, amount, time FROM notes WHERE user_id=? AND day BETWEEN ? AND ? AND (day, id) < (?, ?) "
+            "ORDER BY day DESC, id DESC LIMIT ?",
+            (user_id, month * 100, last_day, last_day, last_id, NOTES_PAGE_SIZE + 1)
         ).fetchall()
-        if not rows:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("⏪ 上月尚無紀錄", quick_reply=back_menu()))
-            return
-        total = 0
-        msg = "⏪ 上月紀錄\n\n"
-        for r in rows:
-            total += int(r["amount"])
-            msg += f"{r['time']}｜{int(r['amount']):+}\n"
-        msg += f"\n💰 合計：{total:+}"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(msg, quick_reply=back_menu()))
-        return
+    else:
+        rows = db.execute(
+            "SELECT id, day, amount, time FROM notes WHERE user_id=? AND day BETWEEN ? AND ? "
+            "ORDER BY day DESC, id DESC LIMIT ?",
+            (user_id, month * 100, last_day, NOTES_PAGE_SIZE + 1)
+        ).fetchall()
+    more = len(rows) > NOTES_PAGE_SIZE
+    rows = rows[:NOTES_PAGE_SIZE]
 
-    if text == "清除紀錄":
-        db.execute("DELETE FROM notes WHERE user_id=?", (user_id,))
-        db.commit()
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("🧹 已清除紀錄", quick_reply=back_menu()))
+    msg = f"{title}{'（續）' if after else ''}\n\n"
+    for r in rows:
+        msg += f"{r['time']}｜{int(r['amount']):+}\n"
+    if after or more:
+        msg += f"\n📄 共 {summary['count']} 筆"
+    msg += f"\n💰 合計：{int(summary['total']):+}"
+    if not more:
+        return text_msg(msg, quick_reply=QR_BACK)
+    cursor = f"notes={view}:{month}:{rows[-1]['day']}:{rows[-1]['id']}"
+    return text_msg(msg, quick_reply=quick_reply(postback_button("➡️ 下一頁", cursor), BTN_BACK))
+
+
+@router.command("記事本")
+def on_notes(event, db, user_id, text, st):
+    sessions.put(db, user_id, {"mode": "note_menu"})
+    reply(event.reply_token, NOTE_MENU)
+
+
+@router.command("新增紀錄")
+def on_note_add(event, db, user_id, text, st):
+    sessions.put(db, user_id, {"mode": "note_amount"})
+    reply(event.reply_token, text_msg("請輸入金額，例如：1000 或 -500", quick_reply=QR_BACK))
+
+
+@router.state("note_amount")
+def on_note_amount(event, db, user_id, text, st):
+    val = text.strip()
+    if not re.fullmatch(r"-?\d+", val):
+        reply(event.reply_token, text_msg("請直接輸入金額，例如：1000 或 -500", quick_reply=QR_BACK))
         return
+    amount = int(val)
+    note_add(db, user_id, amount, datetime.now())
+    commit(db)
+    sessions.clear(db, user_id)
+    reply(event.reply_token, text_msg(f"✅ 已新增：{amount:+}", quick_reply=QR_BACK))
 
-    # ===== 店家合作 =====
-    if text == "店家合作":
-        row = db.execute("SELECT shop_id, name, approved, open, group_link FROM shops WHERE owner_id=? ORDER BY rowid DESC", (user_id,)).fetchone()
-        if not row:
-            user_state[user_id] = {"mode": "shop_apply"}
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("請輸入店家名稱", quick_reply=back_menu()))
-            return
-        if int(row["approved"] or 0) != 1:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("⏳ 尚未審核通過，請等待管理員審核", quick_reply=back_menu()))
-            return
 
-        status = "🟢 營業中" if int(row["open"] or 0) == 1 else "🔴 未營業"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(
-            f"🏪 {row['name']}\n{status}",
-            quick_reply=QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="🟢 開始營業", text="開始營業")),
-                QuickReplyButton(action=MessageAction(label="🔴 今日休息", text="今日休息")),
-                QuickReplyButton(action=MessageAction(label="🔗 設定群組", text="設定群組")),
-                QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-            ])
-        ))
+@router.command("查看當月")
+def on_note_this_month(event, db, user_id, text, st):
+    month = int(datetime.now().strftime("%Y%m"))
+    reply(event.reply_token, note_month_msg(db, user_id, "this", month))
+
+
+@router.command("查看上月")
+def on_note_last_month(event, db, user_id, text, st):
+    last_month_end = datetime.now().replace(day=1) - timedelta(days=1)
+    month = int(last_month_end.strftime("%Y%m"))
+    reply(event.reply_token, note_month_msg(db, user_id, "last", month))
+
+
+@router.command("清除紀錄")
+def on_note_clear(event, db, user_id, text, st):
+    note_clear(db, user_id)
+    commit(db)
+    reply(event.reply_token, text_msg("🧹 已清除紀錄", quick_reply=QR_BACK))
+
+
+# ===== 店家合作 =====
+@router.command("店家合作")
+def on_partner(event, db, user_id, text, st):
+    row = db.execute("SELECT shop_id, name, approved, open, group_link FROM shops WHERE owner_id=? ORDER BY rowid DESC", (user_id,)).fetchone()
+    if not row:
+        sessions.put(db, user_id, {"mode": "shop_apply"})
+        reply(event.reply_token, text_msg("請輸入店家名稱", quick_reply=QR_BACK))
+        return
+    if int(row["approved"] or 0) != 1:
+        reply(event.reply_token, text_msg("⏳ 尚未審核通過，請等待管理員審核", quick_reply=QR_BACK))
         return
 
-    if user_state.get(user_id, {}).get("mode") == "shop_apply":
-        name = text.strip()[:30]
-        sid = f"{user_id}_{int(time.time())}"
-        db.execute(
-            "INSERT OR REPLACE INTO shops(shop_id, name, open, approved, group_link, owner_id, partner_map) VALUES(?,?,0,0,'',?, '')",
-            (sid, name, user_id)
-        )
-        db.commit()
-        user_state.pop(user_id, None)
-        ss_clear(db, user_id)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("✅ 已送出申請，等待管理員審核", quick_reply=back_menu()))
+    status = "🟢 營業中" if int(row["open"] or 0) == 1 else "🔴 未營業"
+    reply(event.reply_token, text_msg(
+        f"🏪 {row['name']}\n{status}",
+        quick_reply=QR_SHOP_OWNER
+    ))
+
+
+@router.state("shop_apply")
+def on_shop_apply(event, db, user_id, text, st):
+    name = text.strip()[:30]
+    sid = f"{user_id}_{int(time.time())}"
+    db.execute(
+        "INSERT OR REPLACE INTO shops(shop_id, name, open, approved, group_link, owner_id, partner_map) VALUES(?,?,0,0,'',?, '')",
+        (sid, name, user_id)
+    )
+    commit(db)
+    shops_changed()
+    sessions.clear(db, user_id)
+    reply(event.reply_token, text_msg("✅ 已送出申請，等待管理員審核", quick_reply=QR_BACK))
+
+
+@router.command("開始營業")
+def on_shop_open(event, db, user_id, text, st):
+    row = db.execute("SELECT shop_id FROM shops WHERE owner_id=? ORDER BY rowid DESC", (user_id,)).fetchone()
+    if not row:
+        reply(event.reply_token, text_msg("你尚未綁定店家", quick_reply=QR_BACK))
         return
+    db.execute("UPDATE shops SET open=1 WHERE shop_id=?", (row["shop_id"],))
+    commit(db)
+    shops_changed()
+    reply(event.reply_token, text_msg("🟢 已開始營業", quick_reply=QR_BACK))
 
-    if text == "開始營業":
-        row = db.execute("SELECT shop_id FROM shops WHERE owner_id=? ORDER BY rowid DESC", (user_id,)).fetchone()
-        if not row:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("你尚未綁定店家", quick_reply=back_menu()))
-            return
-        db.execute("UPDATE shops SET open=1 WHERE shop_id=?", (row["shop_id"],))
-        db.commit()
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("🟢 已開始營業", quick_reply=back_menu()))
+
+@router.command("今日休息")
+def on_shop_close(event, db, user_id, text, st):
+    row = db.execute("SELECT shop_id FROM shops WHERE owner_id=? ORDER BY rowid DESC", (user_id,)).fetchone()
+    if not row:
+        reply(event.reply_token, text_msg("你尚未綁定店家", quick_reply=QR_BACK))
         return
+    db.execute("UPDATE shops SET open=0 WHERE shop_id=?", (row["shop_id"],))
+    commit(db)
+    shops_changed()
+    reply(event.reply_token, text_msg("🔴 今日休息", quick_reply=QR_BACK))
 
-    if text == "今日休息":
-        row = db.execute("SELECT shop_id FROM shops WHERE owner_id=? ORDER BY rowid DESC", (user_id,)).fetchone()
-        if not row:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("你尚未綁定店家", quick_reply=back_menu()))
-            return
-        db.execute("UPDATE shops SET open=0 WHERE shop_id=?", (row["shop_id"],))
-        db.commit()
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("🔴 今日休息", quick_reply=back_menu()))
+
+@router.command("設定位置")
+def on_set_location(event, db, user_id, text, st):
+    sessions.put(db, user_id, {"mode": "shop_location", "until": time.time() + LOCATION_INPUT_SEC})
+    reply(event.reply_token, text_msg("請傳送店家位置（附近店家會用這個位置排序）", quick_reply=QR_SEND_LOCATION))
+
+
+@router.command("設定群組")
+def on_set_group(event, db, user_id, text, st):
+    sessions.put(db, user_id, {"mode": "set_group"})
+    reply(event.reply_token, text_msg("請貼上群組邀請連結（https://line.me/...）", quick_reply=QR_BACK))
+
+
+@router.state("set_group")
+def on_set_group_input(event, db, user_id, text, st):
+    link = text.strip()
+    row = db.execute("SELECT shop_id FROM shops WHERE owner_id=? ORDER BY rowid DESC", (user_id,)).fetchone()
+    if not row:
+        sessions.clear(db, user_id)
+        reply(event.reply_token, text_msg("你尚未綁定店家", quick_reply=QR_BACK))
+        return
+    db.execute("UPDATE shops SET group_link=? WHERE shop_id=?", (link, row["shop_id"]))
+    commit(db)
+    shops_changed()
+    sessions.clear(db, user_id)
+    reply(event.reply_token, text_msg("✅ 已設定群組連結", quick_reply=QR_BACK))
+
+
+# ===== 店家地圖 =====
+@router.command("店家地圖")
+def on_shop_maps(event, db, user_id, text, st):
+    if not shop_dir.open_shops(db):
+        reply(event.reply_token, text_msg("目前沒有營業的店家", quick_reply=QR_BACK))
+        return
+    reply(event.reply_token, shop_picker_msg(db, "map"))
+
+
+def nearby_msg(db, lat, lng):
+    found = shop_dir.nearest(db, lat, lng)
+    if not found:
+        return text_msg(f"📍 附近 {NEARBY_MAX_KM:g} 公里內沒有營業中的店家", quick_reply=quick_reply(BTN_NEARBY, BTN_BACK))
+    msg = "📍 離你最近的營業店家\n"
+    for i, (d, s) in enumerate(found, 1):
+        msg += f"\n{i}. {s['name']}｜{f'{d * 1000:.0f} m' if d < 1 else f'{d:.1f} km'}"
+    items = [button(("🗺 " + (s["name"] or ""))[:20], f"地圖:{s['shop_id']}") for _d, s in found if (s["partner_map"] or "").strip()]
+    return text_msg(msg, quick_reply=picker(items))
+
+
+@router.prefix("地圖:")
+def on_shop_map(event, db, user_id, text, st):
+    sid = text.split(":", 1)[1].strip()
+    row = shop_dir.get_open(db, sid)
+    if not row or not (row["partner_map"] or "").strip():
+        reply(event.reply_token, text_msg("此店家尚未設定地圖連結", quick_reply=QR_BACK))
         return
+    name = row["name"] or "店家"
+    link = row["partner_map"].strip()
+    reply(event.reply_token, text_msg(
+        f"🗺 {name} 地圖\n{link}",
+        quick_reply=quick_reply(uri_button("📍 開啟地圖", link), BTN_BACK)
+    ))
+
+
+# ===== 店家配桌 =====
+@router.command("店家配桌")
+def on_match(event, db, user_id, text, st):
+    row = db.execute("SELECT shop_id, amount, people, status, table_id FROM match_users WHERE user_id=?", (user_id,)).fetchone()
+    if row:
+        # ✅ 若正在「成桌確認」階段，優先顯示「加入/放棄」
+        if row["status"] == "ready":
+            reply(
+                event.reply_token,
+                MATCH_CONFIRMING
+            )
+            return
 
-    if text == "設定群組":
-        user_state[user_id] = {"mode": "set_group"}
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("請貼上群組邀請連結（https://line.me/...）", quick_reply=back_menu()))
+        reply(event.reply_token, MATCH_EXISTING)
         return
 
-    if user_state.get(user_id, {}).get("mode") == "set_group":
-        link = text.strip()
-        row = db.execute("SELECT shop_id FROM shops WHERE owner_id=? ORDER BY rowid DESC", (user_id,)).fetchone()
-        if not row:
-            user_state.pop(user_id, None)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("你尚未綁定店家", quick_reply=back_menu()))
-            return
-        db.execute("UPDATE shops SET group_link=? WHERE shop_id=?", (link, row["shop_id"]))
-        db.commit()
-        user_state.pop(user_id, None)
-        ss_clear(db, user_id)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("✅ 已設定群組連結", quick_reply=back_menu()))
+    sessions.clear(db, user_id)
+    reply(event.reply_token, shop_picker_msg(db, "match"))
+
+
+@router.command("查看進度")
+def on_match_status(event, db, user_id, text, st):
+    row = db.execute("SELECT shop_id, amount, people, status FROM match_users WHERE user_id=?", (user_id,)).fetchone()
+    if not row:
+        reply(event.reply_token, main_menu(user_id))
         return
+    shop = shop_dir.get(db, row["shop_id"])
+    reply(event.reply_token, text_msg(
+        f"📌 配桌狀態\n\n🏪 {(shop and shop['name']) or '未知店家'}\n💰 {row['amount']}\n👥 {int(row['people'])} 人\n📍 {row['status']}",
+        quick_reply=QR_MATCH_STATUS
+    ))
 
-    # ===== 店家地圖 =====
-    if text == "店家地圖":
-        rows = db.execute("SELECT shop_id, name, partner_map FROM shops WHERE open=1 AND approved=1 ORDER BY rowid DESC").fetchall()
-        if not rows:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("目前沒有營業的店家", quick_reply=back_menu()))
-            return
-        rows_with_link = [r for r in rows if (r["partner_map"] or "").strip()]
-        if not rows_with_link:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("目前沒有可開啟的地圖（店家尚未設定地圖連結）", quick_reply=back_menu()))
-            return
-        items = [QuickReplyButton(action=MessageAction(label=(r["name"] or "")[:20], text=f"地圖:{r['shop_id']}")) for r in rows_with_link]
-        items.append(QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")))
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("請選擇要開啟地圖的店家", quick_reply=QuickReply(items=items)))
+
+@router.prefix("店家:")
+def on_pick_shop(event, db, user_id, text, st):
+    sid = text.split(":", 1)[1].strip()
+    sessions.put(db, user_id, {"mode": "wait_amount", "shop_id": sid})
+    reply(event.reply_token, AMOUNT_PICKER)
+
+
+@router.prefix("金額:")
+def on_pick_amount(event, db, user_id, text, st):
+    amount = text.split(":", 1)[1].strip()
+    if not st.get("shop_id"):
+        reply(event.reply_token, text_msg("請先選擇店家", quick_reply=QR_BACK))
+        return
+    st["amount"] = amount
+    sessions.put(db, user_id, st)
+    reply(event.reply_token, PEOPLE_PICKER)
+
+
+@router.prefix("人數:")
+def on_pick_people(event, db, user_id, text, st):
+    people = int(text.split(":", 1)[1].strip())
+    shop_id = st.get("shop_id")
+    amount = st.get("amount")
+    if not shop_id or not amount:
+        reply(event.reply_token, text_msg("資料不足，請重新開始配桌", quick_reply=QR_BACK))
+        sessions.clear(db, user_id)
         return
 
-    if text.startswith("地圖:"):
-        sid = text.split(":", 1)[1].strip()
-        row = db.execute("SELECT name, partner_map FROM shops WHERE shop_id=? AND open=1 AND approved=1", (sid,)).fetchone()
-        if not row or not (row["partner_map"] or "").strip():
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("此店家尚未設定地圖連結", quick_reply=back_menu()))
-            return
-        name = row["name"] or "店家"
-        link = row["partner_map"].strip()
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(
-            f"🗺 {name} 地圖\n{link}",
-            quick_reply=QuickReply(items=[
-                QuickReplyButton(action=URIAction(label="📍 開啟地圖", uri=link)),
-                QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-            ])
-        ))
+    sessions.clear(db, user_id)
+    if not match_pool.join(db, user_id, shop_id, amount, people):
+        # 已經在成桌確認中（例如按到舊的人數按鈕），不能把人從桌上拉走
+        reply(event.reply_token, MATCH_CONFIRMING)
         return
 
-    # ===== 店家配桌 =====
-    if text == "店家配桌":
-        row = db.execute("SELECT shop_id, amount, people, status, table_id FROM match_users WHERE user_id=?", (user_id,)).fetchone()
-        if row:
-            # ✅ 若正在「成桌確認」階段，優先顯示「加入/放棄」
-            if row["status"] == "ready":
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage("你目前在成桌確認中，請選擇：", quick_reply=confirm_menu())
-                )
-                return
+    # 嘗試成桌；把「當前使用者」用 reply 送出，避免多訊息順序問題
+    table_id = try_make_table(shop_id, amount, reply_token=event.reply_token, trigger_user_id=user_id)
+    if table_id:
+        # 成桌訊息已送，這裡不要再回第二則
+        return
 
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(
-                "你目前已有配桌紀錄\n(可查看進度/取消配桌)",
-                quick_reply=QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(label="🔍 查看進度", text="查看進度")),
-                    QuickReplyButton(action=MessageAction(label="❌ 取消配桌", text="取消配桌")),
-                    QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-                ])
-            ))
-            return
+    reply(event.reply_token, MATCH_JOINED)
 
-        ss_clear(db, user_id)
-        shops = db.execute("SELECT shop_id, name FROM shops WHERE open=1 AND approved=1 ORDER BY rowid DESC").fetchall()
-        if not shops:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("目前沒有營業店家", quick_reply=back_menu()))
-            return
 
-        items = [
-            QuickReplyButton(action=PostbackAction(label=(s["name"] or "")[:20], data=f"shop={s['shop_id']}"))
-            for s in shops
-        ]
-        items.append(QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")))
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("請選擇店家", quick_reply=QuickReply(items=items)))
+@router.command("取消配桌")
+def on_cancel(event, db, user_id, text, st):
+    sessions.clear(db, user_id)
+    if cancel_match(db, user_id) == "abandon":
+        reply(event.reply_token, text_msg("❌ 已放棄（等同取消配桌）", quick_reply=QR_BACK))
         return
+    reply(event.reply_token, text_msg("🚪 已取消配桌", quick_reply=QR_BACK))
 
-    if text == "查看進度":
-        row = db.execute("""
-            SELECT s.name, m.amount, m.people, m.status
-            FROM match_users m
-            LEFT JOIN shops s ON m.shop_id = s.shop_id
-            WHERE m.user_id=?
-        """, (user_id,)).fetchone()
-        if not row:
-            line_bot_api.reply_message(event.reply_token, main_menu(user_id))
-            return
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(
-            f"📌 配桌狀態\n\n🏪 {row['name'] or '未知店家'}\n💰 {row['amount']}\n👥 {int(row['people'])} 人\n📍 {row['status']}",
-            quick_reply=QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="❌ 取消配桌", text="取消配桌")),
-                QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-            ])
-        ))
-        return
 
-    if text.startswith("店家:"):
-        sid = text.split(":", 1)[1].strip()
-        user_state[user_id] = {"mode": "wait_amount", "shop_id": sid}
-        ss_set(db, user_id, shop_id=sid, amount=None)
-        items = [
-            QuickReplyButton(action=MessageAction(label="50/20", text="金額:50/20")),
-            QuickReplyButton(action=MessageAction(label="100/20", text="金額:100/20")),
-            QuickReplyButton(action=MessageAction(label="100/50", text="金額:100/50")),
-            QuickReplyButton(action=MessageAction(label="200/50", text="金額:200/50")),
-            QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-        ]
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("請選擇金額", quick_reply=QuickReply(items=items)))
+@router.command("加入")
+def on_confirm(event, db, user_id, text, st):
+    row = db.execute("SELECT table_id FROM match_users WHERE user_id=? AND status='ready'", (user_id,)).fetchone()
+    if not row or not row["table_id"]:
+        reply(event.reply_token, main_menu(user_id))
         return
 
-    if text.startswith("金額:"):
-        amount = text.split(":", 1)[1].strip()
-        st = user_state.get(user_id, {})
-        if not st.get("shop_id"):
-            sid_db, _amt_db = ss_get(db, user_id)
-            if sid_db:
-                st["shop_id"] = sid_db
-                user_state[user_id] = st
-        if not st.get("shop_id"):
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("請先選擇店家", quick_reply=back_menu()))
-            return
-        st["amount"] = amount
-        user_state[user_id] = st
-        ss_set(db, user_id, amount=amount)
-        items = [
-            QuickReplyButton(action=MessageAction(label="我1人", text="人數:1")),
-            QuickReplyButton(action=MessageAction(label="我2人", text="人數:2")),
-            QuickReplyButton(action=MessageAction(label="我3人", text="人數:3")),
-            QuickReplyButton(action=MessageAction(label="我4人", text="人數:4")),
-            QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-        ]
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("請選擇人數", quick_reply=QuickReply(items=items)))
+    table_id = row["table_id"]
+    # CAS：讀到之後桌子若已到期 / 作廢，這裡就更新不到
+    cur = db.execute(
+        "UPDATE match_users SET status='confirmed' WHERE user_id=? AND status='ready' AND table_id=?",
+        (user_id, table_id)
+    )
+    if cur.rowcount != 1:
+        reply(event.reply_token, main_menu(user_id))
         return
+    commit(db)
 
-    if text.startswith("人數:"):
-        people = int(text.split(":", 1)[1].strip())
-        st = user_state.get(user_id, {})
-        shop_id = st.get("shop_id")
-        amount = st.get("amount")
-        if not shop_id or not amount:
-            sid_db, amt_db = ss_get(db, user_id)
-            shop_id = shop_id or sid_db
-            amount = amount or amt_db
-        if not shop_id or not amount:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("資料不足，請重新開始配桌", quick_reply=back_menu()))
-            user_state.pop(user_id, None)
-            return
+    push_table(table_id, "✅ 有玩家加入")
 
-        db.execute("""
-            INSERT OR REPLACE INTO match_users(user_id, people, shop_id, amount, status, expire, table_id, table_index)
-            VALUES(?, ?, ?, ?, 'waiting', NULL, NULL, NULL)
-        """, (user_id, people, shop_id, amount))
-        db.commit()
-        user_state.pop(user_id, None)
-        ss_clear(db, user_id)
+    # 每一組都確認（確認人數湊滿 4 人）才成功；2+2、3+1 這種桌只有 2 組
+    seats, pending = table_seats(db, table_id)
+    if seats >= 4 or not pending:
+        finalize_success(table_id)
 
-        # 嘗試成桌；把「當前使用者」用 reply 送出，避免多訊息順序問題
-        table_id = try_make_table(shop_id, amount, reply_token=event.reply_token, trigger_user_id=user_id)
-        if table_id:
-            # 成桌訊息已送，這裡不要再回第二則
-            return
+    reply(event.reply_token, text_msg("✅ 已確認加入", quick_reply=QR_BACK))
 
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(
-            "✅ 已加入配桌等待中",
-            quick_reply=QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="🔍 查看進度", text="查看進度")),
-                QuickReplyButton(action=MessageAction(label="❌ 取消配桌", text="取消配桌")),
-                QuickReplyButton(action=MessageAction(label="🔙 回主選單", text="選單")),
-            ])
-        ))
-        return
 
-    if text == "取消配桌":
-        # ✅ 若在「成桌確認」中，取消配桌等同於放棄：自己退出，其他人回等待池繼續配桌
-        strow = db.execute("SELECT status FROM match_users WHERE user_id=?", (user_id,)).fetchone()
-        if strow and (strow["status"] in ("ready", "confirmed")):
-            handle_abandon(user_id)
-            user_state.pop(user_id, None)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("❌ 已放棄（等同取消配桌）", quick_reply=back_menu()))
-            return
+@router.command("放棄")
+def on_abandon(event, db, user_id, text, st):
+    handle_abandon(user_id)
+    sessions.clear(db, user_id)
+    reply(event.reply_token, text_msg("❌ 已放棄（等同取消配桌）", quick_reply=QR_BACK))
 
-        # 其他狀態：維持原本取消
-        row = db.execute("SELECT shop_id, amount FROM match_users WHERE user_id=?", (user_id,)).fetchone()
-        if row:
-            shop_id, amount = row["shop_id"], row["amount"]
-            db.execute("DELETE FROM match_users WHERE user_id=?", (user_id,))
-            db.commit()
-            try_make_table(shop_id, amount)
-        user_state.pop(user_id, None)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("🚪 已取消配桌", quick_reply=back_menu()))
-        return
 
-    if text == "加入":
-        row = db.execute("SELECT table_id FROM match_users WHERE user_id=? AND status='ready'", (user_id,)).fetchone()
-        if not row or not row["table_id"]:
-            line_bot_api.reply_message(event.reply_token, main_menu(user_id))
-            return
+# ===== 店家選單（分頁 / 店名搜尋）=====
+# 每頁 SHOP_PAGE_SIZE 家 +「下一頁」+「搜尋店名」（店家地圖第一頁再加「附近店家」）+「回主選單」，不會超過 quick reply 13 顆的上限。
+# 翻頁用 postback 游標 shops=<kind>:<上一頁最後一家 rowid>（搜尋時再帶 :<開頭字數>:<最後一家店名>），搜尋是 shopsearch=<kind>。
+# 沒搜尋時照 rowid DESC（新的在前），搜尋時照 (店名, rowid)；兩種都是 keyset，每頁成本跟店家數無關。
+# 玩家的清單（營業中）走 shop_dir 記憶體，管理員的清單（含未營業 / 未審核）直接查 DB 索引。
 
-        table_id = row["table_id"]
-        db.execute("UPDATE match_users SET status='confirmed' WHERE user_id=?", (user_id,))
-        db.commit()
+def shop_status_line(r):
+    return f"{r['name']}\n狀態：{'營業中' if r['open'] else '未營業'} | {'✅通過' if r['approved'] else '❌未審核'}\nID:{r['shop_id']}"
 
-        push_table(table_id, "✅ 有玩家加入")
 
-        # 4 人都確認才成功
-        cnt = db.execute("SELECT COUNT(*) AS c FROM match_users WHERE table_id=? AND status='confirmed'", (table_id,)).fetchone()["c"]
-        if cnt >= 4:
-            finalize_success(table_id)
+# kind -> (標題, 沒有店家時的訊息, 清單來源, 限管理員, 按鈕；None = 文字列表)
+SHOP_PICKERS = {
+    "match": ("請選擇店家", "目前沒有營業店家", "open", False,
+              lambda r: postback_button((r["name"] or "")[:20], f"shop={r['shop_id']}")),
+    "map": ("請選擇要開啟地圖的店家", "目前沒有可開啟的地圖（店家尚未設定地圖連結）", "map", False,
+            lambda r: button((r["name"] or "")[:20], f"地圖:{r['shop_id']}")),
+    "list": ("🏪 店家列表", "目前沒有店家", "all", True, None),
+    "review": ("選擇要審核的店家", "目前沒有店家", "all", True,
+               lambda r: button((r["name"] or "")[:20], f"管理:審核:{r['shop_id']}")),
+    "delete": ("選擇要刪除的店家", "目前沒有店家", "all", True,
+               lambda r: button((r["name"] or "")[:20], f"管理:刪除:{r['shop_id']}")),
+    "mapset": ("選擇要設定地圖的店家", "目前沒有已核准店家", "approved", True,
+               lambda r: button((r["name"] or "")[:20], f"管理:地圖:{r['shop_id']}")),
+}
+
+# 來源 -> (依新舊的條件, 搜尋店名的條件)
+# 依新舊時寫成 +approved：不讓 SQLite 改用 idx_shops_approved_name 再整批排序，直接沿 rowid DESC 走、邊走邊過濾
+SHOP_SOURCES_SQL = {
+    "all": ("", ""),
+    "approved": ("+approved=1 AND ", "approved=1 AND "),
+}
+
+
+def prefix_end(prefix):
+    # 店名開頭 = prefix 的範圍上界：name >= prefix AND name < prefix_end(prefix)（BINARY 排序）
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def shop_db_page(db, source, after=None, prefix=""):
+    recent_cond, name_cond = SHOP_SOURCES_SQL[source]
+    if not prefix:
+        rows = db.execute(
+            f"SELECT rowid, shop_id, name, open, approved FROM shops WHERE {recent_cond}rowid < ? ORDER BY rowid DESC LIMIT ?",
+            (after if after is not None else 2 ** 63 - 1, SHOP_PAGE_SIZE + 1)
+        ).fetchall()
+    else:
+        last_name, last_rowid = after if after is not None else (prefix, -1)
+        rows = db.execute(
+            f"SELECT rowid, shop_id, name, open, approved FROM shops WHERE {name_cond}name >= ? AND name < ? AND (name, rowid) > (?, ?) "
+            "ORDER BY name, rowid LIMIT ?",
+            (prefix, prefix_end(prefix), last_name, last_rowid, SHOP_PAGE_SIZE + 1)
+        ).fetchall()
+    return rows[:SHOP_PAGE_SIZE], len(rows) > SHOP_PAGE_SIZE
+
+
+def shop_picker_msg(db, kind, after=None, prefix=""):
+    title, empty, source, _admin, make_button = SHOP_PICKERS[kind]
+    if source in SHOP_SOURCES_SQL:
+        rows, more = shop_db_page(db, source, after, prefix)
+    else:
+        rows, more = shop_dir.page(db, source, after, prefix)
+    search = postback_button("🔍 搜尋店名", f"shopsearch={kind}")
+    if not rows:
+        if prefix:
+            return text_msg(f"找不到店名開頭是「{prefix}」的店家", quick_reply=quick_reply(search, BTN_BACK))
+        return text_msg(empty, quick_reply=QR_BACK)
+
+    heading = title + (f"（店名：{prefix}）" if prefix else "") + ("（續）" if after is not None else "")
+    items = [make_button(r) for r in rows] if make_button else []
+    if more:
+        last = rows[-1]
+        # 搜尋結果的店名都以 prefix 開頭：游標帶最後一家的店名 + prefix 長度，就能還原排序鍵跟搜尋字
+        cursor = f"{kind}:{last['rowid']}:{len(prefix)}:{last['name']}" if prefix else f"{kind}:{last['rowid']}"
+        items.append(postback_button("➡️ 下一頁", "shops=" + cursor))
+    items.append(search)
+    if kind == "map" and after is None and not prefix:
+        items.append(BTN_NEARBY)
+    if make_button:
+        return text_msg(heading, quick_reply=picker(items))
+    return text_msg(heading + "\n\n" + "\n\n".join(shop_status_line(r) for r in rows), quick_reply=picker(items))
+
+
+def parse_shop_cursor(raw):
+    # <kind>:<rowid> 或 <kind>:<rowid>:<n>:<店名>（搜尋；prefix = 店名前 n 字）
+    # 回傳 (kind, after, prefix)；格式不對（舊版按鈕、被竄改）回 None
+    parts = raw.split(":", 3)
+    if len(parts) not in (2, 4) or parts[0] not in SHOP_PICKERS or not parts[1].isdigit():
+        return None
+    rowid = int(parts[1])
+    if len(parts) == 2:
+        return parts[0], rowid, ""
+    n, name = parts[2], parts[3]
+    if not n.isdigit() or not 0 < int(n) <= len(name):
+        return None
+    return parts[0], (name, rowid), name[:int(n)]
 
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("✅ 已確認加入", quick_reply=back_menu()))
+
+def shop_picker_allowed(user_id, kind):
+    return kind in SHOP_PICKERS and (user_id in ADMIN_IDS or not SHOP_PICKERS[kind][3])
+
+
+@router.state("shop_search")
+def on_shop_search(event, db, user_id, text, st):
+    kind = st.get("kind")
+    if not shop_picker_allowed(user_id, kind):
+        sessions.clear(db, user_id)
+        reply(event.reply_token, main_menu(user_id))
         return
+    sessions.clear(db, user_id)
+    reply(event.reply_token, shop_picker_msg(db, kind, prefix=text.strip()[:20]))
+
 
-    if text == "放棄":
-        handle_abandon(user_id)
-        user_state.pop(user_id, None)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("❌ 已放棄（等同取消配桌）", quick_reply=back_menu()))
+@handler.add(MessageEvent, message=TextMessage)
+@transactional
+def handle_message(event):
+    db = get_db()
+
+    user_id = event.source.user_id
+    text = (event.message.text or "").strip()
+    st = sessions.get(db, user_id)
+    if st.get("mode") == "shop_location":
+        # 等店家位置的狀態只給下一則位置訊息用：改打別的指令就結束，之後傳位置是找附近店家
+        sessions.clear(db, user_id)
+        st = {}
+
+    route = router.resolve(user_id, text, st.get("mode"))
+    if route is not None:
+        set_command(route.fn.__name__)
+        route.fn(event, db, user_id, text, st)
         return
 
     # ===== 其他文字：回主選單 =====
-    line_bot_api.reply_message(event.reply_token, main_menu(user_id))
+    set_command("main_menu")
+    reply(event.reply_token, main_menu(user_id))
+
+
+# ===== 傳位置：設定店家位置 / 找附近店家 =====
+@handler.add(MessageEvent, message=LocationMessage)
+@transactional
+def handle_location(event):
+    db = get_db()
+
+    user_id = event.source.user_id
+    lat, lng = event.message.latitude, event.message.longitude
+    st = sessions.get(db, user_id)
+    mode = st.get("mode")
+
+    setting = mode == "shop_location" or (mode == "admin_map_input" and user_id in ADMIN_IDS)
+    if setting and time.time() > st.get("until", 0):
+        # 很久以前按的「設定位置」/ 地圖設定：不要拿這次的位置蓋掉店家座標，當成找附近店家
+        sessions.clear(db, user_id)
+        setting = False
+
+    if setting:
+        if mode == "shop_location":
+            row = db.execute("SELECT shop_id FROM shops WHERE owner_id=? ORDER BY rowid DESC", (user_id,)).fetchone()
+            sid = row and row["shop_id"]
+        else:
+            sid = st["sid"]
+        sessions.clear(db, user_id)
+        if not sid:
+            reply(event.reply_token, text_msg("你尚未綁定店家", quick_reply=QR_BACK))
+            return
+        db.execute("UPDATE shops SET lat=?, lng=? WHERE shop_id=?", (lat, lng, sid))
+        commit(db)
+        shops_changed()
+        reply(event.reply_token, text_msg("✅ 已設定店家位置", quick_reply=QR_BACK))
+        return
+
+    reply(event.reply_token, nearby_msg(db, lat, lng))
 
 
 # ---- Render 啟動 ----
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
-    with app.app_context():
-        init_db()
     app.run(host="0.0.0.0", port=port)
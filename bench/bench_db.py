@@ -0,0 +1,93 @@
+# 連線管理效益：同一個「加入」事件的 SQL 序列，比較
+#   舊：每次事件開新連線（預設 rollback journal），push_table / notify_table 各自再開一條
+#   新：app.get_db() 執行緒長駐連線（WAL + synchronous=NORMAL + statement cache）
+#
+#   python bench/bench_db.py [事件數]
+import os, sys, time, sqlite3, tempfile, statistics
+
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+os.chdir(tempfile.mkdtemp(prefix="bench_db_"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+TABLE_ID = "bench_table"
+USERS = [f"U{i:032d}" for i in range(4)]
+
+
+def seed(db):
+    db.execute("DELETE FROM match_users")
+    db.execute("DELETE FROM tables")
+    db.execute("INSERT INTO tables(id, shop_id, amount, table_index, created, r20, r10) VALUES(?,?,?,?,?,0,0)",
+               (TABLE_ID, "s", "100/20", 1, time.time()))
+    for uid in USERS:
+        db.execute("INSERT INTO match_users VALUES(?,?,?,?,?,?,?,?)",
+                   (uid, 1, "s", "100/20", "ready", time.time() + 30, TABLE_ID, 1))
+        db.execute("INSERT OR REPLACE INTO nicknames(user_id, nickname) VALUES(?,?)", (uid, uid[-4:]))
+    db.commit()
+
+
+def join_event(conn_for, uid):
+    # handle_message「加入」
+    db = conn_for()
+    db.execute("SELECT table_id FROM match_users WHERE user_id=? AND status='ready'", (uid,)).fetchone()
+    db.execute("UPDATE match_users SET status='ready' WHERE user_id=?", (uid,))
+    db.commit()
+    # push_table：組桌況（每位玩家一次暱稱查詢）
+    db2 = conn_for()
+    rows = db2.execute("SELECT user_id, status, people FROM match_users WHERE table_id=? ORDER BY rowid", (TABLE_ID,)).fetchall()
+    for r in rows:
+        db2.execute("SELECT nickname FROM nicknames WHERE user_id=?", (r["user_id"],)).fetchone()
+    db2.execute("SELECT MIN(expire) AS ex FROM match_users WHERE table_id=? AND expire IS NOT NULL", (TABLE_ID,)).fetchone()
+    # 確認人數
+    db.execute("SELECT COUNT(*) AS c FROM match_users WHERE table_id=? AND status='confirmed'", (TABLE_ID,)).fetchone()
+
+
+def run(label, conn_for, done):
+    lat = []
+    for i in range(N):
+        t0 = time.perf_counter()
+        join_event(conn_for, USERS[i % 4])
+        done()
+        lat.append((time.perf_counter() - t0) * 1e6)
+    lat.sort()
+    print(f"{label:<10} mean {statistics.mean(lat):8.1f} us   p50 {lat[len(lat) // 2]:8.1f} us   p99 {lat[int(len(lat) * 0.99)]:8.1f} us")
+    return statistics.mean(lat)
+
+
+def main():
+    seed(app.get_db())
+
+    opened = []
+
+    def per_event():
+        db = sqlite3.connect(app.DB_PATH, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        opened.append(db)
+        return db
+
+    def close_all():
+        while opened:
+            opened.pop().close()
+
+    # 舊模式跑在 rollback journal 上才公平
+    legacy = "legacy.db"
+    src = sqlite3.connect(app.DB_PATH)
+    src.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    src.execute(f"VACUUM INTO '{legacy}'")
+    src.close()
+    c = sqlite3.connect(legacy)
+    c.execute("PRAGMA journal_mode=DELETE")
+    c.close()
+
+    app.DB_PATH, pooled_path = legacy, app.DB_PATH
+    old = run("per-event", per_event, close_all)
+    app.DB_PATH = pooled_path
+    new = run("pooled", app.get_db, lambda: None)
+    print(f"saved per event: {old - new:.1f} us ({(1 - new / old) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# 附近店家：N 家店（集中在幾個城市 + 零星散布）時，傳位置找最近 NEARBY_SHOPS 家的查詢延遲
+#   grid：app.ShopGrid 格子索引（shop_dir 實際用的）
+#   scan：每家店都算一次距離再排序（沒有空間索引的做法）
+# 兩者結果要完全一致；最後再經過 shop_dir.nearest 從 DB 載入跑一次完整路徑。
+#
+#   python bench/bench_nearby.py [店家數 ...]
+import os, sys, time, random, tempfile
+
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+os.chdir(tempfile.mkdtemp(prefix="bench_nearby_"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+SIZES = [int(a) for a in sys.argv[1:]] or [1000, 10000, 50000]
+QUERIES = 2000
+CITIES = [(25.04, 121.53), (24.15, 120.67), (22.63, 120.30), (23.00, 120.21), (24.80, 120.97), (24.99, 121.30)]
+
+
+def make_shops(n, rnd):
+    shops = []
+    for i in range(n):
+        if rnd.random() < 0.8:
+            clat, clng = rnd.choice(CITIES)
+            lat, lng = rnd.gauss(clat, 0.08), rnd.gauss(clng, 0.08)
+        else:
+            lat, lng = rnd.uniform(21.9, 25.3), rnd.uniform(120.0, 122.0)
+        shops.append({"rowid": i + 1, "shop_id": f"s{i}", "name": f"店{i}", "lat": lat, "lng": lng, "partner_map": ""})
+    return shops
+
+
+def make_queries(rnd):
+    out = []
+    for _ in range(QUERIES):
+        clat, clng = rnd.choice(CITIES)
+        out.append((rnd.gauss(clat, 0.1), rnd.gauss(clng, 0.1)))
+    return out
+
+
+def scan(shops, lat, lng, k, max_km):
+    found = []
+    for s in shops:
+        d = app.distance_km(lat, lng, s["lat"], s["lng"])
+        if d <= max_km:
+            found.append((d, s["rowid"], s))
+    found.sort(key=lambda x: x[:2])
+    return [(d, s) for d, _rowid, s in found[:k]]
+
+
+def timed(fn, queries):
+    lat = []
+    results = []
+    for q in queries:
+        t0 = time.perf_counter()
+        results.append(fn(*q))
+        lat.append((time.perf_counter() - t0) * 1e6)
+    lat.sort()
+    return lat, results
+
+
+def fmt(lat):
+    return f"p50 {lat[len(lat) // 2]:9.1f} us   p99 {lat[int(len(lat) * 0.99)]:9.1f} us"
+
+
+def main():
+    k, max_km = app.NEARBY_SHOPS, app.NEARBY_MAX_KM
+    print(f"k={k}  max {max_km:g} km  cell {app.SHOP_GRID_DEG}°  {QUERIES} queries")
+    for n in SIZES:
+        rnd = random.Random(n)
+        shops = make_shops(n, rnd)
+        queries = make_queries(rnd)
+
+        t0 = time.perf_counter()
+        grid = app.ShopGrid(shops, app.SHOP_GRID_DEG)
+        build = time.perf_counter() - t0
+
+        g_lat, g_res = timed(lambda a, b: grid.nearest(a, b, k, max_km), queries)
+        s_lat, s_res = timed(lambda a, b: scan(shops, a, b, k, max_km), queries[:200])
+        same = all([s["rowid"] for _d, s in g] == [s["rowid"] for _d, s in r] for g, r in zip(g_res, s_res))
+
+        print(f"{n:6d} shops  grid build {build * 1e3:6.1f} ms  {len(grid.cells)} cells")
+        print(f"    grid  {fmt(g_lat)}")
+        print(f"    scan  {fmt(s_lat)}   same results: {same}")
+
+    # 完整路徑：DB -> shop_dir（載入時建 grid）-> nearest
+    db = app.get_db()
+    shops = make_shops(SIZES[-1], random.Random(0))
+    db.executemany(
+        "INSERT INTO shops(shop_id, name, open, approved, group_link, owner_id, partner_map, lat, lng) VALUES(?,?,1,1,'','','',?,?)",
+        [(s["shop_id"], s["name"], s["lat"], s["lng"]) for s in shops]
+    )
+    db.commit()
+    app.shop_dir.bump()
+    t0 = time.perf_counter()
+    app.shop_dir.nearest(db, *CITIES[0])
+    load = time.perf_counter() - t0
+    lat, _ = timed(lambda a, b: app.shop_dir.nearest(db, a, b), make_queries(random.Random(1)))
+    print(f"shop_dir.nearest, {SIZES[-1]} shops from DB: first call (cache load) {load * 1e3:.1f} ms, then {fmt(lat)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# 整池配桌：
+#   1. 只算記憶體：N 組排一池（隨機人數 / 照先來後到會少湊桌的 1,1,1,1,3,3,3,3 循環），
+#      比較照先來後到（skip 0）/ 預設 MATCH_SKIP_LIMIT / 不限跳過 的桌數與耗時，跟理論最多桌數（max_tables）對照
+#   2. 連 DB：同一池一次開完所有桌（一個交易） vs 舊做法一次觸發只開一桌（每桌一個交易）
+#
+#   python bench/bench_pack.py [組數]
+import os, sys, time, random, tempfile
+
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+os.chdir(tempfile.mkdtemp(prefix="bench_pack_"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+POOL = ("bench_shop", "100/20")
+
+
+class Stub:
+    def reply_message(self, *a, **kw): pass
+    def push_message(self, *a, **kw): pass
+    def multicast(self, *a, **kw): pass
+
+
+def seed(db, n, pattern=None):
+    rnd = random.Random(1)
+    if pattern:
+        people = [pattern[i % len(pattern)] for i in range(n)]
+    else:
+        people = rnd.choices((1, 2, 3, 4), weights=(6, 3, 2, 1), k=n)
+    db.execute("DELETE FROM match_users")
+    db.execute("DELETE FROM tables")
+    db.executemany(
+        "INSERT INTO match_users(user_id, people, shop_id, amount, status) VALUES(?,?,?,?, 'waiting')",
+        [(f"U{i:08d}", p, POOL[0], POOL[1]) for i, p in enumerate(people)]
+    )
+    db.commit()
+    app.match_pool.load(db)
+
+
+def waiting_rank(db):
+    # 還在等的組裡，最早排隊的是第幾個（越前面代表越多人被跳過）
+    row = db.execute("SELECT MIN(rowid) FROM match_users WHERE status='waiting'").fetchone()
+    first = db.execute("SELECT MIN(rowid) FROM match_users").fetchone()[0]
+    return None if row[0] is None else row[0] - first
+
+
+def plan_only(db, label):
+    buckets = app.match_pool.pools[POOL]
+    counts = {p: len(b) for p, b in buckets.items()}
+    print(f"{label}: {N} parties {counts}, at most {app.max_tables(counts)} tables")
+    for name, limit in (("fifo (skip 0)", 0), (f"skip {app.MATCH_SKIP_LIMIT}", app.MATCH_SKIP_LIMIT), ("skip unlimited", 10 ** 9)):
+        t0 = time.perf_counter()
+        plan = app.match_pool.pack(POOL[0], POOL[1], limit)
+        dt = time.perf_counter() - t0
+        seated = {uid for table in plan for uid, _p, _seq in table}
+        oldest_left = next((i for i, uid in enumerate(sorted(app.match_pool.members, key=lambda u: app.match_pool.members[u][2]))
+                            if uid not in seated), None)
+        print(f"  {name:<16} {len(plan):6d} tables  {dt * 1e3:8.1f} ms  oldest party left waiting: #{oldest_left}")
+
+
+def one_per_trigger(db):
+    # 舊做法：每次觸發只開一桌、各自一個交易
+    tables = 0
+    while True:
+        db.execute("BEGIN IMMEDIATE")
+        with app.match_pool.pool_lock(POOL):
+            plan = app.match_pool.pack(POOL[0], POOL[1], 0, limit=1)
+            for selected in plan:
+                if app.seat_table(db, POOL[0], POOL[1], selected):
+                    app.match_pool.take([uid for uid, _p, _seq in selected])
+                    tables += 1
+        db.commit()
+        if not plan:
+            return tables
+
+
+def main():
+    app.set_line_api(Stub())
+    app.COUNTDOWN_READY = 3600
+    db = app.get_db()
+
+    seed(db, N)
+    plan_only(db, "random")
+    seed(db, N, pattern=(1, 1, 1, 1, 3, 3, 3, 3))
+    plan_only(db, "pattern 1,1,1,1,3,3,3,3")
+
+    seed(db, N)
+    t0 = time.perf_counter()
+    tables = one_per_trigger(db)
+    old = time.perf_counter() - t0
+    print(f"one table per transaction: {tables} tables in {old:.2f}s")
+
+    seed(db, N)
+    app.scheduler.cancel_if(lambda group: True)
+    t0 = time.perf_counter()
+    with app.unit_of_work():
+        app.try_make_table(*POOL)
+    new = time.perf_counter() - t0
+    tables = db.execute("SELECT COUNT(*) FROM tables").fetchone()[0]
+    print(f"whole pool, one transaction: {tables} tables in {new:.2f}s (incl. scheduling + notifications), "
+          f"oldest waiting #{waiting_rank(db)}")
+    app.scheduler.cancel_if(lambda group: True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# 指令分派成本：同一批文字指令，比較
+#   舊：依原本 if-chain 順序逐條比對（完全相同 / startswith / mode）
+#   新：app.router.resolve()（dict 查表 + 前綴長度切片 + mode 查表）
+# 只量「決定要進哪個 handler」這一步，不執行 handler 本身。
+#
+#   python bench/bench_router.py [每個指令次數]
+import os, sys, time, tempfile
+
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+os.chdir(tempfile.mkdtemp(prefix="bench_router_"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+USER = "U" + "0" * 32
+
+# (文字, 當下 mode)
+CASES = [
+    ("選單", None),
+    ("店家配桌", None),
+    ("店家:shop_1", None),
+    ("金額:100/20", "wait_amount"),
+    ("人數:2", "wait_amount"),
+    ("加入", None),
+    ("放棄", None),
+    ("1000", "note_amount"),
+    ("地圖:shop_1", None),
+    ("隨便打的字", None),
+]
+
+
+def linear_table():
+    # 把 router 的規則攤平成原本 if-chain 的樣子：依優先序逐條檢查
+    rules = []
+    for t, r in app.router.exact.items():
+        rules.append((r.order, "exact", t, r))
+    for p, r in app.router.prefixes.items():
+        rules.append((r.order, "prefix", p, r))
+    for m, r in app.router.modes.items():
+        rules.append((r.order, "mode", m, r))
+    rules.sort(key=lambda x: x[0])
+    return rules
+
+
+def linear_resolve(rules, user_id, text, mode):
+    is_admin = user_id in app.ADMIN_IDS
+    for _order, kind, key, r in rules:
+        if r.admin and not is_admin:
+            continue
+        if kind == "exact":
+            hit = text == key and (r.mode is None or r.mode == mode)
+        elif kind == "prefix":
+            hit = text.startswith(key)
+        else:
+            hit = mode == key
+        if hit:
+            return r
+    return None
+
+
+def run(label, resolve):
+    per = {}
+    for text, mode in CASES:
+        t0 = time.perf_counter()
+        for _ in range(N):
+            resolve(USER, text, mode)
+        per[text] = (time.perf_counter() - t0) / N * 1e9
+    print(f"{label:<8}" + "".join(f"{v:8.0f}" for v in per.values()) + f"   | mean {sum(per.values()) / len(per):6.0f} ns")
+    return per
+
+
+def main():
+    rules = linear_table()
+    for text, mode in CASES:
+        assert linear_resolve(rules, USER, text, mode) is app.router.resolve(USER, text, mode), text
+    print(f"{len(rules)} rules, {N} calls per command (ns/call)")
+    print(" " * 8 + "".join(f"{t[:6]:>8}" for t, _ in CASES))
+    old = run("linear", lambda u, t, m: linear_resolve(rules, u, t, m))
+    new = run("router", app.router.resolve)
+    worst = max(CASES, key=lambda c: old[c[0]])[0]
+    print(f"worst case ({worst}): {old[worst]:.0f} -> {new[worst]:.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+# 端到端壓測：用 channel secret 簽章的 /callback 請求模擬大量使用者，
+# line_bot_api 換成本機錄製用的 stub（不打 LINE），量 webhook 處理延遲 / 吞吐 / 成桌速度 / 每事件 SQL 數。
+#
+# 情境（每位使用者）：
+#   1. 逛選單：選單 / 店家地圖 / 記事本 / 查看當月 / 設定暱稱 ...（隨機幾個）
+#   2. 配桌：店家配桌 → 選店家（postback）→ 金額 → 人數
+#   3. 成桌後：加入 / 放棄 / 不理它（等到期）
+#
+#   python bench/loadtest.py [--users 2000] [--shops 5] [--concurrency 8] [--batch 1] [--async] [--api-ms 0]
+#   多事件 webhook 的並行效果：--batch 10 --api-ms 20，比較 DELIVERY_WORKERS=1 跟預設
+import os, sys, json, hmac, time, base64, random, hashlib, argparse, tempfile, threading, statistics
+from collections import Counter
+from itertools import zip_longest
+
+SECRET = "loadtest-secret"
+HERE = os.path.dirname(os.path.abspath(__file__))
+AMOUNTS = ("50/20", "100/20", "100/50", "200/50")
+
+
+def parse():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--shops", type=int, default=5)
+    ap.add_argument("--concurrency", type=int, default=8, help="同時送 webhook 的執行緒數")
+    ap.add_argument("--batch", type=int, default=1, help="每個 webhook 請求帶幾位使用者的事件（LINE 可能一次送多個）")
+    ap.add_argument("--async", dest="use_async", action="store_true", help="CALLBACK_ASYNC=1（先回 200，背景佇列處理）")
+    ap.add_argument("--confirm", type=float, default=0.7, help="成桌後按加入的比例")
+    ap.add_argument("--abandon", type=float, default=0.15, help="成桌後按放棄的比例（其餘等到期）")
+    ap.add_argument("--api-ms", type=float, default=0, help="stub 每次 LINE API 呼叫要花的毫秒數")
+    ap.add_argument("--seed", type=int, default=1)
+    return ap.parse_args()
+
+
+class RecordingStub:
+    # 取代 LineBotApi：只記錄呼叫，照 SDK 的方式把訊息轉成 dict（序列化成本也算進去）
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.texts = Counter()
+
+    def _record(self, kind, messages):
+        if self.delay:
+            time.sleep(self.delay)
+        messages = messages if isinstance(messages, (list, tuple)) else [messages]
+        heads = [(m.as_json_dict().get("text") or "").split("\n", 1)[0] for m in messages]
+        with self.lock:
+            self.calls[kind] += 1
+            for h in heads:
+                self.texts[h] += 1
+
+    def reply_message(self, reply_token, messages, **kw):
+        self._record("reply", messages)
+
+    def push_message(self, to, messages, **kw):
+        self._record("push", messages)
+
+    def multicast(self, to, messages, **kw):
+        self._record("multicast", messages)
+
+
+class SqlCounter:
+    # 掛在每條連線的 trace callback 上數 SQL 句數
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = Counter()
+
+    def __call__(self, sql):
+        kind = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "?"
+        with self.lock:
+            self.kinds[kind] += 1
+
+    def total(self):
+        with self.lock:
+            return sum(self.kinds.values())
+
+
+def load_app(use_async):
+    os.environ["LINE_CHANNEL_ACCESS_TOKEN"] = "loadtest"
+    os.environ["LINE_CHANNEL_SECRET"] = SECRET
+    os.environ["CALLBACK_ASYNC"] = "1" if use_async else "0"
+    os.chdir(tempfile.mkdtemp(prefix="loadtest_"))
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    import app
+    app.COUNTDOWN_READY = 3600  # 到期由第三段直接觸發，壓測中途不要自己到期
+    return app
+
+
+def sign(body):
+    return base64.b64encode(hmac.new(SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+class Events:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.n = 0
+
+    def _base(self, user_id):
+        with self.lock:
+            self.n += 1
+            n = self.n
+        return {
+            "mode": "active", "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": user_id},
+            "replyToken": f"rt{n}", "webhookEventId": f"ev{n}",
+            "deliveryContext": {"isRedelivery": False},
+        }
+
+    def text(self, user_id, text):
+        e = self._base(user_id)
+        e.update(type="message", message={"type": "text", "id": str(self.n), "text": text})
+        return e
+
+    def postback(self, user_id, data):
+        e = self._base(user_id)
+        e.update(type="postback", postback={"data": data})
+        return e
+
+
+def browse_steps(rnd, ev, uid):
+    steps = [
+        [("選單",)],
+        [("店家地圖",)],
+        [("記事本",), ("查看當月",)],
+        [("記事本",), ("新增紀錄",), (str(rnd.randint(-3000, 3000)),)],
+        [("設定暱稱",), (f"玩家{uid[-4:]}",)],
+        [("查看進度",)],
+    ]
+    out = []
+    for seq in rnd.sample(steps, rnd.randint(1, 3)):
+        out.extend(ev.text(uid, t) for (t,) in seq)
+    return out
+
+
+def join_steps(rnd, ev, uid, shops):
+    return [
+        ev.text(uid, "店家配桌"),
+        ev.postback(uid, f"shop={rnd.choice(shops)}"),
+        ev.text(uid, f"金額:{rnd.choice(AMOUNTS)}"),
+        ev.text(uid, f"人數:{rnd.choices((1, 2, 3, 4), weights=(6, 3, 1, 1))[0]}"),
+    ]
+
+
+def run_phase(app, scripts, concurrency, batch):
+    # scripts: 每位使用者一串事件；同一使用者依序送（跟 LINE 一樣），不同使用者並行。
+    # batch > 1：一次拿 batch 位使用者，每個請求帶每人的下一個事件（像 LINE 把多人的事件併成一次 webhook）
+    work = list(scripts)
+    lock = threading.Lock()
+    latencies = []
+
+    def worker():
+        client = app.app.test_client()
+        mine = []
+        while True:
+            with lock:
+                if not work:
+                    break
+                group, work[-batch:] = work[-batch:], []
+            for step in zip_longest(*group):
+                body = json.dumps({"destination": "Uloadtest", "events": [e for e in step if e]}, ensure_ascii=False)
+                t0 = time.perf_counter()
+                r = client.post("/callback", data=body.encode(), headers={"X-Line-Signature": sign(body), "Content-Type": "application/json"})
+                mine.append(time.perf_counter() - t0)
+                if r.status_code != 200:
+                    print("callback", r.status_code, r.get_data(as_text=True)[:200])
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    t0 = time.perf_counter()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    if app.event_queue.started:
+        app.event_queue.join()
+    return time.perf_counter() - t0, latencies
+
+
+def pct(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+class Tally:
+    # 包住 app 的成桌 / 配桌成功 / 到期函式計次（訊息會被合併，不能只看文字）
+    def __init__(self, app):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        seat, finalize, expire = app.seat_table, app.finalize_success, app.table_expire
+
+        def seat_table(db, *a):
+            seated = seat(db, *a)
+            if seated:
+                self.add("formed")
+            return seated
+
+        def finalize_success(table_id, *a, **kw):
+            self.add("success")
+            return finalize(table_id, *a, **kw)
+
+        def table_expire(table_id):
+            if app.get_db().execute("SELECT 1 FROM tables WHERE id=?", (table_id,)).fetchone():
+                self.add("expired")
+            return expire(table_id)
+
+        app.seat_table, app.finalize_success, app.table_expire = seat_table, finalize_success, table_expire
+
+    def add(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+
+def main():
+    args = parse()
+    app = load_app(args.use_async)
+    rnd = random.Random(args.seed)
+
+    stub = RecordingStub(args.api_ms / 1000.0)
+    app.set_line_api(stub)
+    tally = Tally(app)
+    sql = SqlCounter()
+    connect = app.connect_db
+
+    def traced_connect():
+        db = connect()
+        db.set_trace_callback(sql)
+        return db
+
+    app.connect_db = traced_connect
+    app._db_local.db = None  # 匯入時建的連線也換成有 trace 的
+
+    db = app.get_db()
+    shops = [f"shop{i}" for i in range(args.shops)]
+    for sid in shops:
+        db.execute(
+            "INSERT INTO shops(shop_id, name, open, approved, group_link, owner_id, partner_map) VALUES(?,?,1,1,'',?,?)",
+            (sid, f"測試店{sid[4:]}", f"Uowner{sid}", "https://maps.example.com/" + sid)
+        )
+    db.commit()
+    app.shop_dir.bump()
+    sql.kinds.clear()
+
+    ev = Events()
+    users = [f"U{i:032x}" for i in range(args.users)]
+
+    # 第一段：逛選單 + 加入配桌
+    scripts = [browse_steps(rnd, ev, uid) + join_steps(rnd, ev, uid, shops) for uid in users]
+    events1 = sum(len(s) for s in scripts)
+    t1, lat1 = run_phase(app, scripts, args.concurrency, args.batch)
+
+    # 第二段：成桌確認中的玩家 加入 / 放棄 / 不理
+    ready = [r["user_id"] for r in app.get_db().execute("SELECT user_id FROM match_users WHERE status='ready'")]
+    fate = Counter()
+    scripts = []
+    for uid in ready:
+        x = rnd.random()
+        if x < args.confirm:
+            scripts.append([ev.text(uid, "加入")])
+            fate["confirm"] += 1
+        elif x < args.confirm + args.abandon:
+            scripts.append([ev.text(uid, "放棄")])
+            fate["abandon"] += 1
+        else:
+            fate["idle"] += 1
+    events2 = sum(len(s) for s in scripts)
+    t2, lat2 = run_phase(app, scripts, args.concurrency, args.batch)
+    statements = Counter(sql.kinds)
+    formed = tally.counts["formed"]
+
+    # 第三段：沒人理的桌子到期（跟排程器同一條路徑，不算進吞吐）；
+    # 到期回池的玩家會被 matcher 重新配成新桌（同樣沒人理），一直做到沒有桌子為止
+    lat3 = []
+    while True:
+        app.matcher.flush()
+        rows = app.get_db().execute("SELECT id FROM tables").fetchall()
+        if not rows:
+            break
+        for r in rows:
+            app.scheduler.cancel(r["id"])
+            t0 = time.perf_counter()
+            with app.app.app_context():
+                app.table_expire(r["id"])
+            lat3.append(time.perf_counter() - t0)
+    app.notifier.flush_all()
+    app.dispatcher.join()
+
+    events = events1 + events2
+    elapsed = t1 + t2
+    lat = sorted(lat1 + lat2)
+    print(f"users {args.users}, {args.shops} shops x {len(AMOUNTS)} amounts, concurrency {args.concurrency}, "
+          f"{args.batch} user(s)/request, async {app.CALLBACK_ASYNC}, delivery workers {app.DELIVERY_WORKERS}, "
+          f"LINE API {args.api_ms:g}ms")
+    print(f"events {events} in {elapsed:.2f}s -> {events / elapsed:.0f} events/s "
+          f"(browse+join {events1} in {t1:.2f}s, decide {events2} in {t2:.2f}s)")
+    print(f"request latency ms: p50 {pct(lat, 0.50) * 1e3:.2f}  p95 {pct(lat, 0.95) * 1e3:.2f}  "
+          f"p99 {pct(lat, 0.99) * 1e3:.2f}  max {lat[-1] * 1e3:.2f}  mean {statistics.mean(lat) * 1e3:.2f}")
+    if app.CALLBACK_ASYNC:
+        print(f"  (async: latency is the webhook ack; queue {app.event_queue.stats()})")
+    print(f"tables formed {formed} -> {formed / elapsed:.1f} tables/s")
+    print(f"ready players: confirm {fate['confirm']}  abandon {fate['abandon']}  idle {fate['idle']}  -> "
+          f"tables succeeded {tally.counts['success']}  expired {tally.counts['expired']}")
+    if lat3:
+        lat3.sort()
+        print(f"expire latency ms: p50 {pct(lat3, 0.50) * 1e3:.2f}  p99 {pct(lat3, 0.99) * 1e3:.2f}")
+    top = ", ".join(f"{k} {v / events:.2f}" for k, v in statements.most_common(6))
+    print(f"DB statements per event: {sum(statements.values()) / events:.2f} ({top})")
+    print(f"LINE API calls: {dict(stub.calls)}")
+
+    # 每位玩家都按加入時，每張成立的桌子都要成功、不能有任何一桌到期（人數少於 4 組的桌也一樣）
+    problems = []
+    if args.confirm >= 1.0:
+        if tally.counts["success"] != formed or tally.counts["expired"]:
+            problems.append(f"all players confirmed but only {tally.counts['success']}/{formed} tables succeeded, "
+                            f"{tally.counts['expired']} expired")
+    left = app.get_db().execute("SELECT COUNT(*) FROM tables").fetchone()[0]
+    if left:
+        problems.append(f"{left} tables still open after expiry")
+    if problems:
+        print("FAILED")
+        for p in problems:
+            print("  " + p)
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
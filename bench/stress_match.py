@@ -0,0 +1,169 @@
+# 配桌併發壓力測試：多執行緒（可加多 process）同時對多個池加入 / 取消 / 放棄，
+# 結束後檢查沒有任何玩家被重複配桌：
+#   1. 每張進行中的桌子剛好 4 人、全部是 ready
+#   2. 每個 ready 的玩家都對得到存在的桌子
+#   3. 沒有池還湊得出一桌卻沒成桌
+#   4. 單一 process 時，記憶體配桌池 == DB 裡的 waiting
+#
+#   python bench/stress_match.py [--procs 1] [--threads 16] [--ops 300] [--shops 4]
+import os, sys, json, time, random, argparse, tempfile, subprocess, threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AMOUNTS = ("100/20", "200/50")
+
+
+def parse():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--procs", type=int, default=1)
+    ap.add_argument("--threads", type=int, default=16)
+    ap.add_argument("--ops", type=int, default=300)
+    ap.add_argument("--shops", type=int, default=4)
+    ap.add_argument("--users", type=int, default=40, help="每個執行緒的玩家數")
+    ap.add_argument("--child", type=int, default=None)
+    ap.add_argument("--dir", default=None)
+    return ap.parse_args()
+
+
+def load_app(workdir):
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    import app
+
+    class Stub:
+        def reply_message(self, *a, **kw): pass
+        def push_message(self, *a, **kw): pass
+        def multicast(self, *a, **kw): pass
+
+    app.set_line_api(Stub())
+    app.COUNTDOWN_READY = 3600  # 壓測期間不要到期
+    return app
+
+
+def run_worker(app, proc, args):
+    pools = [(f"s{i}", a) for i in range(args.shops) for a in AMOUNTS]
+    stats = {"join": 0, "cancel": 0, "abandon": 0, "tables": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def thread_main(t):
+        rnd = random.Random(proc * 1000 + t)
+        users = [f"U{proc}_{t}_{i}" for i in range(args.users)]
+        local = {"join": 0, "cancel": 0, "abandon": 0, "tables": 0, "errors": 0}
+        for _ in range(args.ops):
+            uid = rnd.choice(users)
+            try:
+                with app.unit_of_work() as db:
+                    row = db.execute("SELECT shop_id, amount, status FROM match_users WHERE user_id=?", (uid,)).fetchone()
+                    if row is None:
+                        shop_id, amount = rnd.choice(pools)
+                        app.match_pool.join(db, uid, shop_id, amount, rnd.choice((1, 1, 2, 2, 3, 4)))
+                        if app.try_make_table(shop_id, amount):
+                            local["tables"] += 1
+                        local["join"] += 1
+                    elif row["status"] == "waiting":
+                        # 跟「取消配桌」同一條路徑；讀到 waiting 之後可能已經被別的執行緒配進桌子
+                        local[app.cancel_match(db, uid) or "cancel"] += 1
+                    else:
+                        app.handle_abandon(uid)
+                        local["abandon"] += 1
+            except Exception as e:
+                local["errors"] += 1
+                print(f"[{proc}:{t}] {type(e).__name__}: {e}", file=sys.stderr)
+            finally:
+                app.release_db()
+        with lock:
+            for k, v in local.items():
+                stats[k] += v
+
+    threads = [threading.Thread(target=thread_main, args=(t,)) for t in range(args.threads)]
+    t0 = time.perf_counter()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    app.matcher.flush()  # 放棄 / 取消後回池的玩家由 matcher 非同步配桌，檢查前先處理完
+    stats["elapsed"] = time.perf_counter() - t0
+    stats["conflicts"] = app.match_pool.conflicts
+    app.dispatcher.join()
+    return stats
+
+
+def can_make_table(counts):
+    from itertools import product
+    for c4, c3, c2, c1 in product(range(2), range(2), range(3), range(5)):
+        if c4 * 4 + c3 * 3 + c2 * 2 + c1 == 4 and c4 <= counts[4] and c3 <= counts[3] and c2 <= counts[2] and c1 <= counts[1]:
+            return True
+    return False
+
+
+def check(db, app=None):
+    problems = []
+    for t in db.execute("SELECT id FROM tables").fetchall():
+        rows = db.execute("SELECT people, status FROM match_users WHERE table_id=?", (t["id"],)).fetchall()
+        seats = sum(int(r["people"]) for r in rows)
+        if seats != 4 or any(r["status"] != "ready" for r in rows):
+            problems.append(f"table {t['id']}: {seats} seats, {[r['status'] for r in rows]}")
+    orphans = db.execute("""
+        SELECT COUNT(*) FROM match_users m
+        WHERE m.status != 'waiting' AND NOT EXISTS (SELECT 1 FROM tables t WHERE t.id = m.table_id)
+    """).fetchone()[0]
+    if orphans:
+        problems.append(f"{orphans} ready players without a table")
+    waiting = {}
+    for r in db.execute("SELECT user_id, shop_id, amount, people FROM match_users WHERE status='waiting'"):
+        waiting.setdefault((r["shop_id"], r["amount"]), {1: 0, 2: 0, 3: 0, 4: 0})[int(r["people"])] += 1
+    for key, counts in waiting.items():
+        if can_make_table(counts):
+            problems.append(f"pool {key} can still seat a table: {counts}")
+    if app is not None:
+        mem = {uid: m[0] for uid, m in app.match_pool.members.items()}
+        dbw = {r["user_id"]: (r["shop_id"], r["amount"]) for r in db.execute("SELECT user_id, shop_id, amount FROM match_users WHERE status='waiting'")}
+        if mem != dbw:
+            problems.append(f"memory pool differs from DB ({len(mem)} vs {len(dbw)})")
+    tables = db.execute("SELECT COUNT(*) FROM tables").fetchone()[0]
+    return tables, problems
+
+
+def main():
+    args = parse()
+    if args.child is not None:
+        app = load_app(args.dir)
+        print(json.dumps(run_worker(app, args.child, args)))
+        return
+
+    workdir = tempfile.mkdtemp(prefix="stress_match_")
+    if args.procs == 1:
+        app = load_app(workdir)
+        stats = run_worker(app, 0, args)
+        tables, problems = check(app.get_db(), app)
+        per = [stats]
+    else:
+        # 多 process：先建好 schema，再同時啟動（MULTI_WORKER=1，走跨 worker 的版本同步 + CAS）
+        env = dict(os.environ, MULTI_WORKER="1")
+        subprocess.run([sys.executable, "-c", "import app"], cwd=workdir, env=dict(env, PYTHONPATH=os.path.join(HERE, ".."),
+                       LINE_CHANNEL_ACCESS_TOKEN="bench", LINE_CHANNEL_SECRET="bench"), check=True, capture_output=True)
+        cmd = [sys.executable, os.path.abspath(__file__), "--dir", workdir, "--threads", str(args.threads),
+               "--ops", str(args.ops), "--shops", str(args.shops), "--users", str(args.users)]
+        children = [subprocess.Popen(cmd + ["--child", str(p)], env=env, stdout=subprocess.PIPE, text=True) for p in range(args.procs)]
+        per = [json.loads(c.communicate()[0].strip().splitlines()[-1]) for c in children]
+        app = load_app(workdir)
+        tables, problems = check(app.get_db())
+
+    total = {k: sum(s[k] for s in per) for k in ("join", "cancel", "abandon", "tables", "errors", "conflicts")}
+    elapsed = max(s["elapsed"] for s in per)
+    ops = total["join"] + total["cancel"] + total["abandon"]
+    print(f"{args.procs} proc x {args.threads} threads, {args.shops * len(AMOUNTS)} pools")
+    print(f"ops {ops} in {elapsed:.2f}s ({ops / elapsed:.0f}/s): join {total['join']}  cancel {total['cancel']}  "
+          f"abandon {total['abandon']}  tables formed {total['tables']}  errors {total['errors']}  CAS conflicts {total['conflicts']}")
+    print(f"live tables {tables}")
+    if problems:
+        print("FAILED")
+        for p in problems[:20]:
+            print("  " + p)
+        sys.exit(1)
+    print("OK: no double assignment")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+# 多 worker 部署：gunicorn 會自動讀取目前目錄的 gunicorn.conf.py
+#   gunicorn app:app
+# 每個 worker 都是獨立 process，共用 data.db；排程由其中一個 worker 以 SQLite lease 選出來跑。
+import multiprocessing
+import os
+
+os.environ.setdefault("MULTI_WORKER", "1")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = 30
+graceful_timeout = 10
+# app 匯入時會啟動背景執行緒（排程 / 推播 / lease），不能 preload 到 master 再 fork
+preload_app = False